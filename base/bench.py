@@ -0,0 +1,429 @@
+"""Нагрузочный стенд для сервера чата (только localhost).
+
+Запускает тысячи имитированных клиентов по протоколу base/client.py: вход, сообщения в общий
+чат, личные (/p) и групповые (/group_msg) с заданной частотой, переподключения. В конце
+печатает время установки соединения, перцентили задержки доставки, пропускную способность
+рассылки и потребление памяти/CPU сервером.
+
+Пример:
+    python bench.py --spawn-server --clients 2000 --processes 4 --duration 30 --rate 0.2 --dm-rate 0.05
+
+С --dispatch N сеть не используется: замеряется разбор N входящих кадров и маршрутизация команд.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from commands import CommandRouter
+from engine import raise_fd_limit
+from protocol import CONTROL_KINDS, FrameDecoder, decode_message, encode_frame, hello_message
+
+LOCALHOSTS = ('127.0.0.1', 'localhost', '::1')
+MARKER = 'bench:'
+KINDS = ('global', 'dm', 'group')
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+class ProcessSampler:
+    """RSS и процессорное время процесса сервера (через psutil или /proc)."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.process = psutil.Process(pid) if psutil and pid else None
+
+    def sample(self):
+        """(rss в байтах, процессорное время в секундах) или (None, None)."""
+        if not self.pid:
+            return None, None
+        if self.process is not None:
+            times = self.process.cpu_times()
+            return self.process.memory_info().rss, times.user + times.system
+        try:
+            with open(f'/proc/{self.pid}/status') as f:
+                rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+            with open(f'/proc/{self.pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            ticks = os.sysconf('SC_CLK_TCK')
+            return rss, (int(fields[11]) + int(fields[12])) / ticks
+        except (OSError, StopIteration, ValueError):
+            return None, None
+
+
+class Stats:
+    def __init__(self):
+        self.connect_times = []
+        self.latencies = {kind: [] for kind in KINDS}
+        self.sent = {kind: 0 for kind in KINDS}
+        self.received = 0
+        self.received_bytes = 0
+        self.errors = 0
+        self.reconnects = 0
+        self.rate_limited = 0  # сообщения, отклонённые ограничением частоты сервера
+        self.delivered = 0
+        self.delivered_bytes = 0
+
+
+class BenchClient:
+    """Один имитированный клиент."""
+
+    def __init__(self, bench, index):
+        self.bench = bench
+        self.index = index
+        self.nickname = f'bench{index}'
+        self.group = f'benchgroup{index % bench.args.groups}' if bench.args.groups else None
+        self.reader = None
+        self.writer = None
+        self.joined = None
+        self.read_task = None
+        self.seq = 0
+
+    async def connect(self):
+        """Вход в чат; время от connect() до приветствия сервера попадает в статистику."""
+        stats = self.bench.stats
+        for attempt in range(20):
+            started = time.perf_counter()
+            self.reader, self.writer = await asyncio.open_connection(self.bench.args.host, self.bench.args.port)
+            self.joined = asyncio.get_running_loop().create_future()
+            self.read_task = asyncio.create_task(self.read_loop())
+            if self.bench.args.binary:
+                self.writer.write(encode_frame(hello_message(compress=self.bench.args.compress)))
+            self.writer.write(encode_frame(self.nickname))
+            if await self.joined:
+                stats.connect_times.append(time.perf_counter() - started)
+                return True
+            # Ник ещё не освободился после переподключения - ждём и пробуем снова.
+            self.writer.close()
+            await asyncio.sleep(0.05 * (attempt + 1))
+        stats.errors += 1
+        return False
+
+    async def read_loop(self):
+        decoder = FrameDecoder(raw=True)
+        stats = self.bench.stats
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                now = time.monotonic_ns()
+                stats.received_bytes += len(data)
+                for frame in decoder.feed(data):
+                    stats.received += 1
+                    msg, control, _ = decode_message(frame)
+                    if control and control[0] == 'error' and control[1].get('code') == 'rate_limited':
+                        stats.rate_limited += 1
+                        continue
+                    if not self.joined.done():
+                        if control and control[0] == 'welcome':
+                            self.joined.set_result(True)
+                        elif 'занят' in msg:
+                            self.joined.set_result(False)
+                        continue
+                    position = msg.find(MARKER)
+                    if position >= 0 and control is None and msg.partition(' ')[0] not in CONTROL_KINDS:
+                        kind, _, sent_at = msg[position + len(MARKER):].split(':', 3)[:3]
+                        self.bench.stats.latencies[kind].append((now - int(sent_at)) / 1e6)
+        except (ConnectionError, ValueError, KeyError):
+            pass
+        finally:
+            if not self.joined.done():
+                self.joined.set_result(False)
+
+    def send(self, kind, text):
+        self.seq += 1
+        body = f'{MARKER}{kind}:{self.seq}:{time.monotonic_ns()}:{text}'
+        if kind == 'dm':
+            target = self.bench.random_peer(self)
+            message = f'/p {target} {body}'
+        elif kind == 'group':
+            message = f'/group_msg {self.group} {body}'
+        else:
+            message = body
+        self.writer.write(encode_frame(message))
+        self.bench.stats.sent[kind] += 1
+
+    async def close(self):
+        if self.writer is None:
+            return
+        try:
+            self.writer.write(encode_frame('CLOSE'))
+            await self.writer.drain()
+            self.writer.close()
+        except ConnectionError:
+            pass
+        if self.read_task:
+            await asyncio.gather(self.read_task, return_exceptions=True)
+
+
+class Bench:
+    """Клиенты одного процесса стенда: индексы first .. first + count - 1 из args.clients."""
+
+    def __init__(self, args, first, count):
+        self.args = args
+        self.first = first
+        self.stats = Stats()
+        self.clients = [BenchClient(self, index) for index in range(first, first + count)]
+        self.payload = 'x' * args.size
+
+    def random_peer(self, client):
+        peer = random.randrange(self.args.clients)
+        if peer == client.index:
+            peer = (peer + 1) % self.args.clients
+        return f'bench{peer}'
+
+    async def connect_all(self):
+        semaphore = asyncio.Semaphore(self.args.connect_concurrency)
+
+        async def connect(client):
+            async with semaphore:
+                try:
+                    await client.connect()
+                except OSError:
+                    self.stats.errors += 1
+
+        await asyncio.gather(*(connect(client) for client in self.clients))
+
+    async def setup_groups(self):
+        """Клиент с индексом g создаёт группу benchgroup<g> и приглашает всех с индексом g mod groups."""
+        groups = self.args.groups
+        for client in self.clients:
+            if client.index < groups and client.writer is not None:
+                client.writer.write(encode_frame(f'/create_group {client.group}'))
+                for member in range(client.index + groups, self.args.clients, groups):
+                    client.writer.write(encode_frame(f'/invite {client.group} bench{member}'))
+        await asyncio.sleep(1)
+
+    async def traffic(self, client, deadline):
+        rates = (('global', self.args.rate), ('dm', self.args.dm_rate), ('group', self.args.group_rate))
+        total = sum(rate for _, rate in rates)
+        if not total:
+            return
+        while True:
+            await asyncio.sleep(min(random.expovariate(total), max(0.0, deadline - time.monotonic())))
+            if time.monotonic() >= deadline:
+                return
+            if client.writer is None or client.writer.is_closing():
+                continue
+            point = random.uniform(0, total)
+            for kind, rate in rates:
+                point -= rate
+                if point <= 0:
+                    if kind != 'group' or client.group:
+                        client.send(kind, self.payload)
+                    break
+
+    async def churn(self, rate, deadline):
+        """Случайные клиенты уходят и тут же возвращаются с тем же ником."""
+        if not rate:
+            return
+        while True:
+            await asyncio.sleep(min(random.expovariate(rate), max(0.0, deadline - time.monotonic())))
+            if time.monotonic() >= deadline:
+                return
+            client = random.choice(self.clients)
+            await client.close()
+            client.writer = None
+            try:
+                await client.connect()
+                self.stats.reconnects += 1
+            except OSError:
+                self.stats.errors += 1
+
+    async def run(self, barrier):
+        """Фазы синхронизированы с остальными процессами: вход, группы, нагрузка, ожидание доставки."""
+        loop = asyncio.get_running_loop()
+        await self.connect_all()
+        await loop.run_in_executor(None, barrier.wait)
+        if self.args.groups:
+            await self.setup_groups()
+        await loop.run_in_executor(None, barrier.wait)
+        received_before = self.stats.received
+        bytes_before = self.stats.received_bytes
+        deadline = time.monotonic() + self.args.duration
+        churn = self.args.churn * len(self.clients) / self.args.clients
+        await asyncio.gather(self.churn(churn, deadline), *(self.traffic(client, deadline) for client in self.clients))
+        await asyncio.sleep(self.args.drain)
+        self.stats.delivered = self.stats.received - received_before
+        self.stats.delivered_bytes = self.stats.received_bytes - bytes_before
+        await loop.run_in_executor(None, barrier.wait)
+        await asyncio.gather(*(client.close() for client in self.clients))
+        return self.stats
+
+
+def run_worker(args, first, count, barrier, results):
+    """Точка входа процесса стенда."""
+    raise_fd_limit()
+    results.put(vars(asyncio.run(Bench(args, first, count).run(barrier))))
+
+
+def merge(parts):
+    stats = Stats()
+    stats.delivered = 0
+    for part in parts:
+        stats.connect_times += part['connect_times']
+        for kind in KINDS:
+            stats.latencies[kind] += part['latencies'][kind]
+            stats.sent[kind] += part['sent'][kind]
+        for name in ('received', 'received_bytes', 'delivered', 'delivered_bytes', 'errors', 'reconnects',
+                     'rate_limited'):
+            setattr(stats, name, getattr(stats, name) + part[name])
+    return stats
+
+
+def report(args, stats, setup_time, elapsed, rss, cpu):
+    connect = sorted(stats.connect_times)
+    print(f'Клиентов: {args.clients} в {args.processes} процессах, ошибок: {stats.errors}, '
+          f'переподключений: {stats.reconnects}, отклонено лимитом частоты: {stats.rate_limited}')
+    print(f'Подключение всех клиентов: {setup_time:.2f} с; на клиента '
+          f'p50={percentile(connect, 0.5) * 1000:.1f} мс p99={percentile(connect, 0.99) * 1000:.1f} мс')
+    for kind in KINDS:
+        values = sorted(stats.latencies[kind])
+        if not stats.sent[kind]:
+            continue
+        print(f'{kind:>6}: отправлено {stats.sent[kind]}, доставлено {len(values)}; задержка '
+              f'p50={percentile(values, 0.5):.2f} p90={percentile(values, 0.9):.2f} '
+              f'p99={percentile(values, 0.99):.2f} max={percentile(values, 1.0):.2f} мс')
+    print(f'Доставлено кадров: {stats.delivered} за {elapsed:.1f} с ({stats.delivered / elapsed:.0f} кадров/с), '
+          f'{stats.delivered_bytes / 2 ** 20:.1f} МиБ ({stats.delivered_bytes / max(stats.delivered, 1):.0f} байт/кадр)')
+    if rss[1] is not None:
+        print(f'Сервер: RSS {rss[0] / 2 ** 20:.1f} -> {rss[1] / 2 ** 20:.1f} МиБ, '
+              f'CPU {(cpu[1] - cpu[0]) / elapsed * 100:.0f}% за время нагрузки')
+
+
+def run_bench(args, sampler):
+    """Раздача клиентов по процессам и сбор общей статистики."""
+    barrier = multiprocessing.Barrier(args.processes + 1)
+    results = multiprocessing.Queue()
+    share, extra = divmod(args.clients, args.processes)
+    workers = []
+    first = 0
+    for number in range(args.processes):
+        count = share + (number < extra)
+        workers.append(multiprocessing.Process(target=run_worker, args=(args, first, count, barrier, results)))
+        first += count
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    setup_time = time.perf_counter() - started
+    barrier.wait()
+    rss_before, cpu_before = sampler.sample()
+    started = time.perf_counter()
+    barrier.wait()
+    elapsed = time.perf_counter() - started
+    rss_after, cpu_after = sampler.sample()
+    stats = merge(results.get() for _ in workers)
+    for worker in workers:
+        worker.join()
+    report(args, stats, setup_time, elapsed, (rss_before, rss_after), (cpu_before, cpu_after))
+
+
+# Команды сервера с их разбиением (как в ChatServer.setup_commands) и смесь входящих сообщений.
+DISPATCH_COMMANDS = (('/p', 2), ('/group_msg', 2), ('/create_group', 2), ('/invite', 2), ('/leave_group', 2),
+                     ('/history', None), ('/search', None), ('/help', None), ('/users', None))
+DISPATCH_MESSAGES = ('привет всем, это сообщение в общий чат', '/p bob как дела?', '/group_msg team встреча в 15:00',
+                     '/history global 1200 50', '/search al 10', '/invite team carol', '/unknown команда')
+
+
+def bench_dispatch(count):
+    """Микробенчмарк: декодирование кадров и разбор с маршрутизацией команд, нс на сообщение."""
+    router = CommandRouter()
+    for name, maxsplit in DISPATCH_COMMANDS:
+        router.register(name, lambda parts, *context: None, maxsplit)
+    messages = [DISPATCH_MESSAGES[i % len(DISPATCH_MESSAGES)] for i in range(count)]
+    data = b''.join(encode_frame(message) for message in messages)
+    chunks = [data[i:i + 64 * 1024] for i in range(0, len(data), 64 * 1024)]
+
+    started = time.perf_counter()
+    decoder = FrameDecoder()
+    decoded = [message for chunk in chunks for message in decoder.feed(chunk)]
+    decode_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for message in decoded:
+        if message[:1] == '/':
+            router.dispatch(message, None, 'bench')
+    dispatch_time = time.perf_counter() - started
+
+    print(f'Сообщений: {count} ({len(data) / 1024 / 1024:.1f} МБ кадров)')
+    print(f'Декодирование кадров:  {decode_time / count * 1e9:8.0f} нс/сообщение')
+    print(f'Разбор и маршрутизация: {dispatch_time / count * 1e9:7.0f} нс/сообщение')
+    print(f'Всего:                 {(decode_time + dispatch_time) / count * 1e9:8.0f} нс/сообщение')
+
+
+def spawn_server(args):
+    """Запуск сервера в отдельном процессе и во временном каталоге (своя chat.db).
+
+    Ограничения частоты отключены, иначе стенд мерил бы отказы rate_limited, а не доставку;
+    их можно вернуть через --server-args.
+    """
+    workdir = tempfile.mkdtemp(prefix='chat-bench-')
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py'),
+               '--port', str(args.port), '--mode', args.server_mode,
+               '--client-rate', '0', '--channel-rate', '0'] + args.server_args
+    process = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(args.startup_delay)
+    return process
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный стенд сервера чата')
+    parser.add_argument('--host', default='127.0.0.1', choices=LOCALHOSTS)
+    parser.add_argument('--port', type=int, default=9090)
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--duration', type=float, default=20, help='длительность нагрузки, с')
+    parser.add_argument('--drain', type=float, default=2, help='ожидание доставки после нагрузки, с')
+    parser.add_argument('--rate', type=float, default=0.1, help='сообщений в общий чат на клиента в секунду')
+    parser.add_argument('--dm-rate', type=float, default=0.0, help='личных сообщений на клиента в секунду')
+    parser.add_argument('--group-rate', type=float, default=0.0, help='групповых сообщений на клиента в секунду')
+    parser.add_argument('--groups', type=int, default=0, help='число групп, по которым распределяются клиенты')
+    parser.add_argument('--churn', type=float, default=0.0, help='переподключений в секунду по всем клиентам')
+    parser.add_argument('--size', type=int, default=32, help='длина текста сообщения')
+    parser.add_argument('--binary', action='store_true', help='согласовать с сервером двоичные кадры')
+    parser.add_argument('--compress', action='store_true', help='со --binary: сжатие крупных кадров')
+    parser.add_argument('--processes', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help='число процессов-генераторов нагрузки')
+    parser.add_argument('--connect-concurrency', type=int, default=200, help='одновременных входов на процесс')
+    parser.add_argument('--server-pid', type=int, help='PID уже запущенного сервера для замера RSS/CPU')
+    parser.add_argument('--spawn-server', action='store_true', help='запустить сервер самостоятельно')
+    parser.add_argument('--server-mode', default='asyncio')
+    parser.add_argument('--server-args', nargs=argparse.REMAINDER, default=[],
+                        help='дополнительные аргументы server.py (в конце командной строки)')
+    parser.add_argument('--startup-delay', type=float, default=1.5)
+    parser.add_argument('--dispatch', type=int, metavar='N',
+                        help='только микробенчмарк разбора и маршрутизации N сообщений, без сервера')
+    args = parser.parse_args()
+
+    if args.dispatch:
+        bench_dispatch(args.dispatch)
+        return
+
+    process = spawn_server(args) if args.spawn_server else None
+    sampler = ProcessSampler(process.pid if process else args.server_pid)
+    try:
+        run_bench(args, sampler)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,377 @@
+"""Шина событий между узлами кластера чата.
+
+Узлы обмениваются событиями - словарями с полем "type", которые передаются JSON в кадрах
+протокола чата: вход и выход пользователей, изменения групп, сообщения. Брокер - единая точка
+упорядочивания: он хранит справочник кластера (на каком узле пользователь и чей токен сессии,
+группы и их участники), атомарно закрепляет ники и имена групп и пересылает события остальным узлам
+в одном и том же порядке. Событие с полем "to" уходит только узлу, к которому подключён адресат.
+
+LocalBus - вырожденная шина одиночного сервера. BrokerBus - клиент брокера Broker, который
+запускается отдельным процессом (python bus.py) или внутри одного из узлов (server.py --broker).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import socket
+import threading
+from urllib.parse import urlsplit
+
+from journal import GroupJournal
+from protocol import FrameDecoder, FrameReader, encode_frame
+from storage import Database
+
+DEFAULT_PORT = 9190
+REQUEST_TIMEOUT = 5
+
+# События, которые меняют справочник брокера.
+DIRECTORY_EVENTS = frozenset({'join', 'leave', 'group_create', 'group_add', 'group_remove',
+                              'detach', 'attach', 'resume'})
+# События только для справочника брокера: другим узлам не пересылаются.
+UNFORWARDED_EVENTS = frozenset({'detach', 'attach'})
+
+
+def encode_event(event):
+    return encode_frame(json.dumps(event, ensure_ascii=False, separators=(',', ':')))
+
+
+def make_bus(url=None, node=None):
+    """Шина по адресу: пусто - одиночный узел, tcp://хост:порт - брокер."""
+    if not url:
+        return LocalBus()
+    parts = urlsplit(url)
+    if parts.scheme != 'tcp' or not parts.port:
+        raise ValueError(f'Неподдерживаемый адрес шины: {url}')
+    return BrokerBus((parts.hostname or '127.0.0.1', parts.port), node)
+
+
+class LocalBus:
+    """Шина одиночного сервера: других узлов нет, всё разрешено, публиковать некому."""
+
+    clustered = False
+    node = 'local'
+
+    def start(self, handler):
+        pass
+
+    def request(self, event, late=None):
+        return {"ok": True}
+
+    def publish(self, event):
+        pass
+
+    def close(self):
+        pass
+
+
+class BrokerBus:
+    """Подключение узла к брокеру: запросы с ответом, публикация и поток приёма событий."""
+
+    clustered = True
+
+    def __init__(self, address, node, timeout=REQUEST_TIMEOUT):
+        if not node:
+            raise ValueError('Для работы в кластере нужно имя узла')
+        self.address = address
+        self.node = node
+        self.timeout = timeout
+        self.sock = None
+        self.handler = None
+        self.send_lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.pending = {}  # {id запроса: callback(ответ или None)}
+
+    def start(self, handler):
+        """Подключение и приветствие. Справочник кластера приходит обработчику событием sync."""
+        self.handler = handler
+        self.sock = socket.create_connection(self.address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = FrameReader(self.sock)
+        self.sock.sendall(encode_event({"type": "hello", "id": 0, "node": self.node}))
+        reply = json.loads(reader.read())
+        if not reply.get('ok'):
+            self.sock.close()
+            raise ConnectionError(f'Брокер отклонил узел {self.node}: имя уже занято')
+        handler(dict(reply, type='sync'))
+        threading.Thread(target=self.read_loop, args=(reader,), name='bus-reader', daemon=True).start()
+
+    def read_loop(self, reader):
+        try:
+            for message in reader:
+                event = json.loads(message)
+                if event['type'] == 'reply':
+                    callback = self.pending.pop(event['id'], None)
+                    if callback is not None:
+                        callback(event)
+                else:
+                    self.handler(event)
+        except (OSError, ValueError) as e:
+            print(f'Ошибка шины: {e}')
+        print(f'Связь с брокером {self.address[0]}:{self.address[1]} потеряна.')
+        while self.pending:
+            self.pending.popitem()[1](None)
+
+    def request(self, event, late=None):
+        """Запрос к брокеру с ожиданием ответа. None, если ответа нет.
+
+        Брокер мог применить запрос и после таймаута: late(ответ) вызывается потоком приёма шины,
+        если такой ответ всё же пришёл и он положительный (например, чтобы освободить занятый ник).
+        """
+        done = threading.Event()
+        lock = threading.Lock()
+        result = [None]
+
+        def resolve(reply):
+            with lock:
+                if not done.is_set():
+                    result[0] = reply
+                    done.set()
+                    return
+            if late is not None and reply and reply.get('ok'):
+                late(reply)
+
+        request_id = self.request_async(event, resolve)
+        if not done.wait(self.timeout):
+            with lock:
+                if not done.is_set():
+                    done.set()
+                    if late is None:
+                        self.pending.pop(request_id, None)
+        return result[0]
+
+    def request_async(self, event, callback):
+        """Запрос без ожидания: callback(ответ или None) вызывается потоком приёма шины. Возвращает id запроса."""
+        request_id = next(self.ids)
+        self.pending[request_id] = callback
+        try:
+            self.send(dict(event, id=request_id))
+        except OSError:
+            if self.pending.pop(request_id, None) is not None:
+                callback(None)
+        return request_id
+
+    def publish(self, event):
+        try:
+            self.send(event)
+        except OSError as e:
+            print(f'Ошибка шины: {e}')
+
+    def send(self, event):
+        data = encode_event(event)
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+
+
+class BrokerProtocol(asyncio.Protocol):
+    """Соединение брокера с одним узлом."""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.transport = None
+        self.node = None
+        self.decoder = FrameDecoder()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        try:
+            for message in self.decoder.feed(data):
+                self.broker.handle(self, json.loads(message))
+        except Exception as e:
+            print(f'Ошибка узла {self.node}: {e}')
+            self.transport.close()
+
+    def send(self, event):
+        self.transport.write(encode_event(event))
+
+    def connection_lost(self, exc):
+        if self.node is not None:
+            self.broker.node_lost(self)
+
+
+class Broker:
+    """Брокер кластера: справочник пользователей и групп, упорядочивание и пересылка событий.
+
+    С db_file группы кластера сохраняются в журнал и восстанавливаются при перезапуске брокера.
+    """
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, db_file=None):
+        self.host = host
+        self.port = port
+        self.nodes = {}  # {node: BrokerProtocol}
+        self.users = {}  # {nickname: node}
+        self.groups = {}  # {group_name: {"owner": nickname, "members": set(nickname, ...)}}
+        # Сессии вошедших пользователей: {токен: ник} и {ник: токен}. По ним любой узел находит владельца
+        # токена (HTTP API одного рабочего процесса обслуживает клиентов всех).
+        self.sessions = {}
+        self.session_tokens = {}
+        # Оборванные сессии, в которые клиент может вернуться через любой узел: {токен: ник} и {ник: токен}.
+        self.detached = {}
+        self.detached_tokens = {}
+        self.ready = threading.Event()
+        self.db = self.journal = None
+        if db_file:
+            self.db = Database(db_file)
+            self.journal = GroupJournal(self.db)
+            self.groups = {name: {"owner": owner, "members": members}
+                           for name, (owner, members) in self.journal.load().items()}
+            self.journal.source = self.group_entries
+
+    def group_entries(self):
+        return [(name, group['owner'], frozenset(group['members'])) for name, group in self.groups.items()]
+
+    def handle(self, peer, event):
+        kind = event['type']
+        if kind == 'hello':
+            self.hello(peer, event)
+            return
+        if peer.node is None:
+            raise ValueError('событие до приветствия')
+        if kind == 'session':
+            nickname = self.sessions.get(event['session'])
+            peer.send({"type": "reply", "id": event['id'], "ok": nickname is not None, "nickname": nickname})
+            return
+        event['node'] = peer.node
+        if kind in DIRECTORY_EVENTS:
+            accepted = self.apply(peer.node, event)
+            if 'id' in event:
+                peer.send({"type": "reply", "id": event.pop('id'), "ok": accepted, "nickname": event.get('nickname')})
+            if not accepted or kind in UNFORWARDED_EVENTS:
+                return
+        if 'to' in event:
+            target = self.nodes.get(self.users.get(event['to']))
+            if target is not None and target is not peer:
+                target.send(event)
+        else:
+            self.forward(event, exclude=peer)
+
+    def hello(self, peer, event):
+        node = event['node']
+        if node in self.nodes:
+            peer.send({"type": "reply", "id": event['id'], "ok": False})
+            return
+        peer.node = node
+        self.nodes[node] = peer
+        groups = {name: {"owner": group['owner'], "members": sorted(group['members'])}
+                  for name, group in self.groups.items()}
+        peer.send({"type": "reply", "id": event['id'], "ok": True, "users": self.users, "groups": groups})
+        print(f'Узел {node} подключён к кластеру.')
+
+    def apply(self, node, event):
+        """Изменение справочника. False - ник или имя группы уже заняты."""
+        kind = event['type']
+        if kind == 'join':
+            if event['nickname'] in self.users:
+                return False
+            self.users[event['nickname']] = node
+            # Токен нужен только брокеру: другим узлам событие уходит без него.
+            token = event.pop('session', None)
+            if token:
+                self.sessions[token] = event['nickname']
+                self.session_tokens[event['nickname']] = token
+        elif kind == 'leave':
+            if self.users.get(event['nickname']) != node:
+                return False
+            del self.users[event['nickname']]
+            self.forget_session(event['nickname'])
+            self.close_session(event['nickname'])
+        elif kind == 'detach':
+            if self.users.get(event['nickname']) != node:
+                return False
+            self.forget_session(event['nickname'])
+            self.detached[event['session']] = event['nickname']
+            self.detached_tokens[event['nickname']] = event['session']
+        elif kind == 'attach':
+            self.forget_session(self.detached.get(event['session']))
+        elif kind == 'resume':
+            # Клиент вернулся через другой узел: ник переходит к нему, прежний узел отпускает сессию.
+            nickname = self.detached.get(event['session'])
+            if nickname is None or nickname not in self.users:
+                return False
+            self.forget_session(nickname)
+            event['nickname'] = nickname
+            self.users[nickname] = node
+        elif kind == 'group_create':
+            if event['group'] in self.groups:
+                return False
+            self.groups[event['group']] = {"owner": event['owner'], "members": {event['owner']}}
+            self.record('create', event['group'], event['owner'])
+        elif kind == 'group_add':
+            self.groups.get(event['group'], {}).get('members', set()).add(event['member'])
+            self.record('add', event['group'], event['member'])
+        elif kind == 'group_remove':
+            self.groups.get(event['group'], {}).get('members', set()).discard(event['member'])
+            self.record('remove', event['group'], event['member'])
+        return True
+
+    def forget_session(self, nickname):
+        token = self.detached_tokens.pop(nickname, None)
+        if token is not None:
+            del self.detached[token]
+
+    def close_session(self, nickname):
+        token = self.session_tokens.pop(nickname, None)
+        if token is not None:
+            del self.sessions[token]
+
+    def record(self, op, group_name, member):
+        if self.journal is not None:
+            self.journal.record(op, group_name, member)
+
+    def forward(self, event, exclude=None):
+        for peer in list(self.nodes.values()):
+            if peer is not exclude:
+                peer.send(event)
+
+    def node_lost(self, peer):
+        """Узел отключился: его пользователи уходят из кластера."""
+        if self.nodes.get(peer.node) is not peer:
+            return
+        del self.nodes[peer.node]
+        print(f'Узел {peer.node} отключился от кластера.')
+        for nickname in [nickname for nickname, node in self.users.items() if node == peer.node]:
+            del self.users[nickname]
+            self.forget_session(nickname)
+            self.close_session(nickname)
+            self.forward({"type": "leave", "nickname": nickname, "node": peer.node})
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: BrokerProtocol(self), self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]  # порт 0 - любой свободный
+        self.ready.set()
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        finally:
+            if self.journal is not None:
+                self.journal.close()
+                self.db.close()
+
+    def start(self):
+        """Запуск брокера в фоновом потоке текущего процесса."""
+        threading.Thread(target=self.run, name='bus-broker', daemon=True).start()
+        if not self.ready.wait(REQUEST_TIMEOUT):
+            raise RuntimeError('Брокер не запустился')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Брокер кластера чата')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--db', default='chat-broker.db', help='файл базы для групп кластера')
+    args = parser.parse_args()
+    print(f'Брокер кластера запущен на {args.host}:{args.port}')
+    Broker(args.host, args.port, db_file=args.db).run()
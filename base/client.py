@@ -1,32 +1,34 @@
 import socket as sk
 import _thread as th
 
+from protocol import FrameReader, decode_message, encode_frame, hello_message, message_text
+
 
 class ChatClient:
     def __init__(self):
         self.socket = sk.socket()
         self.nickname = None
 
-    @staticmethod
-    def get_ip():
-        s = sk.socket(sk.AF_INET, sk.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        ip = s.getsockname()[0]
-        s.close()
-        return ip
-
     def connect_to_server(self, ip, port):
         self.socket.connect((ip, port))
         print(f'Подключено к серверу {ip}:{port}')
-        self.socket.send(self.nickname.encode())
+        self.socket.sendall(encode_frame(hello_message()) + encode_frame(self.nickname))
 
     def listen_messages(self):
         try:
-            while True:
-                msg = self.socket.recv(1024).decode()
-                if not msg:
-                    break
-                print(msg)
+            for frame in FrameReader(self.socket, raw=True):
+                msg, control, _ = decode_message(frame)
+                if control is None:
+                    print(msg)
+                elif control[0] == 'welcome':
+                    print(f"Вы вошли в чат как {control[1]['nickname']}.")
+                elif control[0] == 'error' and control[1].get('code') == 'rate_limited':
+                    print(f"Слишком много сообщений, подождите {control[1]['retry_after']} с.")
+                elif control[0] == 'search':
+                    print('Найдено: ' + ', '.join(control[1]['users'] + control[1]['groups']))
+                elif control[0] in ('history', 'missed'):
+                    for message in control[1]['messages']:
+                        print(message_text(message))
         except Exception as err:
             print(f'Ошибка получения сообщения: {err}')
         finally:
@@ -37,9 +39,9 @@ class ChatClient:
             while True:
                 msg = input('Введите сообщение: ')
                 if msg == 'CLOSE':
-                    self.socket.send('CLOSE'.encode())
+                    self.socket.sendall(encode_frame('CLOSE'))
                     break
-                self.socket.send(msg.encode())
+                self.socket.sendall(encode_frame(msg))
         except Exception as err:
             print(f'Ошибка отправки сообщения: {err}')
         finally:
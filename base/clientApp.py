@@ -1,21 +1,123 @@
-import socket
-import threading
+import os
+import queue
 import tkinter as tk
+from bisect import bisect_left
+from collections import deque
 from tkinter import scrolledtext, messagebox, simpledialog
 
-import requests
+from clientnet import ClientNetwork
+from protocol import hello_message, message_text
 
 base_url = "http://localhost:5000"
+RENDER_INTERVAL = 50  # мс между выводами накопившихся сообщений
+RENDER_BATCH = 1000  # сколько входящих сообщений разбирается за один вывод
+MAX_LINES = 5000  # строк в окне чата; более старые удаляются
+# Автодополнение по Tab: (команда, номер дописываемого слова) -> что подставлять.
+COMPLETIONS = {
+    ("/p", 2): "users",
+    ("/invite", 2): "groups",
+    ("/invite", 3): "users",
+    ("/group_msg", 2): "groups",
+    ("/leave_group", 2): "groups",
+}
+
+
+class SortedListModel:
+    """Отсортированный список для Listbox: в виджет вносятся только добавленные и удалённые строки.
+
+    shown - элементы, подходящие под фильтр, в том же порядке, что и в listbox; фильтр ищет
+    подстроку без учёта регистра.
+    """
+
+    def __init__(self):
+        self.items = []  # все элементы по возрастанию
+        self.shown = []
+        self.query = ''
+        self.listbox = None
+
+    def attach(self, listbox):
+        self.listbox = listbox
+        self.refill()
+
+    def __contains__(self, item):
+        index = bisect_left(self.items, item)
+        return index < len(self.items) and self.items[index] == item
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def matches(self, item):
+        return self.query in item.casefold()
+
+    def replace(self, items):
+        """Новый полный список (снимок с сервера) - применяется как разница с текущим."""
+        new, old = set(items), set(self.items)
+        added, removed = new - old, old - new
+        if len(added) + len(removed) > len(new) // 2:
+            # Список почти целиком другой: пересобрать быстрее, чем вставлять по одному.
+            self.items = sorted(new)
+            self.refill()
+        else:
+            self.update(added, removed)
+
+    def update(self, added=(), removed=()):
+        """Изменение списка: бинарный поиск места и одна вставка или удаление в listbox на элемент."""
+        for item in removed:
+            index = bisect_left(self.items, item)
+            if index < len(self.items) and self.items[index] == item:
+                del self.items[index]
+                if self.matches(item):
+                    position = bisect_left(self.shown, item)
+                    del self.shown[position]
+                    if self.listbox is not None:
+                        self.listbox.delete(position)
+        for item in added:
+            index = bisect_left(self.items, item)
+            if index == len(self.items) or self.items[index] != item:
+                self.items.insert(index, item)
+                if self.matches(item):
+                    position = bisect_left(self.shown, item)
+                    self.shown.insert(position, item)
+                    if self.listbox is not None:
+                        self.listbox.insert(position, item)
+
+    def set_query(self, query):
+        """Смена фильтра; при уточнении запроса отбор идёт по уже показанным элементам."""
+        query = query.casefold()
+        if query == self.query:
+            return
+        source = self.shown if self.query in query else self.items
+        self.query = query
+        self.refill(source)
+
+    def refill(self, source=None):
+        self.shown = [item for item in (self.items if source is None else source) if self.matches(item)]
+        if self.listbox is not None:
+            self.listbox.delete(0, tk.END)
+            if self.shown:
+                self.listbox.insert(tk.END, *self.shown)
 
 
 class ChatClient:
     def __init__(self):
         self.is_group_selected = False
         self.selected_recipient = None
-        self.groups = []  # Список групп
-        self.users = []  # Список пользователей
+        self.groups = SortedListModel()  # Список групп
+        self.users = SortedListModel()  # Список пользователей
+        self.roster_version = None  # Версия списка пользователей, применённая на клиенте
+        self.groups_version = None
         self.message_history = []  # Хранение истории сообщений
+        self.oldest_message_id = None  # id самого раннего загруженного сообщения общего чата
+        self.has_more_history = False
         self.history_index = -1
+        # Сетевой поток складывает разобранные кадры сюда, цикл Tk выводит их пачками.
+        self.inbox = queue.SimpleQueue()
+        self.pending = []  # [(id, текст)] - ещё не выведенные сообщения
+        self.rendered = deque()  # [(id, число строк)] - сообщения в окне чата сверху вниз
+        self.line_count = 0
         self.root = tk.Tk()
         self.root.title("Чат-клиент")
         self.root.geometry("330x230")
@@ -26,20 +128,12 @@ class ChatClient:
         self.nickname = tk.StringVar()
         self.previous_nicknames = []
 
-        self.socket = None
+        self.net = None  # ClientNetwork: сокет чата и HTTP API в фоновом цикле событий
         self.is_connected = False
 
         self.create_main_menu()
         self.root.mainloop()
 
-    @staticmethod
-    def get_ip():
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(('8.8.8.8', 80))
-        ip = s.getsockname()[0]
-        s.close()
-        return ip
-
     def create_main_menu(self):
         """Создаёт главное меню с вводом IP, порта и ника."""
         frame = tk.Frame(self.root, bg="#34495e", padx=20, pady=20)
@@ -65,17 +159,16 @@ class ChatClient:
             return
 
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((ip, int(port)))
-            response = self.socket.recv(1024).decode()
+            if self.net is not None:
+                self.net.close()
+            self.net = ClientNetwork((ip, int(port)), base_url, self.deliver)
+            self.net.versions = lambda: (self.roster_version, self.groups_version)
+            response = self.net.call(self.net.connect())
 
             if response.startswith("/last_nicknames:"):
-                # self.previous_nicknames = response.replace('/last_nicknames: ', '')
-                # self.previous_nicknames = self.previous_nicknames.split(', ')
-                response = requests.get(f"{base_url}/last_nicknames", params={'ip_address': self.get_ip()})
-                if response.status_code == 200:
-                    data = response.json()
-                    self.previous_nicknames = data.get("last_nicknames", []).split(', ')
+                # Сервер уже подобрал ники по адресу, с которого видит подключение.
+                nicknames = response[len("/last_nicknames:"):].split(',')
+                self.previous_nicknames = [nick.strip() for nick in nicknames if nick.strip()]
             else:
                 self.previous_nicknames = []
 
@@ -143,7 +236,8 @@ class ChatClient:
             messagebox.showwarning("Ошибка", "Введите ник!")
             return
         try:
-            self.socket.send(nickname.encode())
+            self.send_frame(hello_message())
+            self.send_frame(nickname)
             self.is_connected = True
 
             self.root.destroy()
@@ -189,35 +283,51 @@ class ChatClient:
         right_frame = tk.Frame(self.chat_window, bg="#34495e", width=200, height=500)
         right_frame.grid(row=0, column=1, rowspan=2, sticky="nse", padx=10, pady=10)
 
+        # Поиск по спискам групп и пользователей
+        self.search_query = tk.StringVar()
+        search_entry = tk.Entry(right_frame, textvariable=self.search_query, font=("Arial", 12), bd=2,
+                                relief="solid")
+        search_entry.grid(row=0, column=0, pady=5, sticky="ew")
+        self.search_query.trace_add("write", self.on_search_changed)
+
         # Список групп
         self.group_label = tk.Label(right_frame, text="Группы", fg="#ecf0f1", bg="#34495e", font=("Arial", 12))
-        self.group_label.grid(row=0, column=0, sticky="w", pady=5)
+        self.group_label.grid(row=1, column=0, sticky="w", pady=5)
 
         self.group_listbox = tk.Listbox(right_frame, height=6, font=("Arial", 12), bd=2, relief="solid")
-        self.group_listbox.grid(row=1, column=0, pady=5, sticky="nsew")
+        self.group_listbox.grid(row=2, column=0, pady=5, sticky="nsew")
         self.group_listbox.bind("<ButtonRelease-1>", self.on_group_selected)
+        self.groups.attach(self.group_listbox)
 
         # Список пользователей
         self.user_label = tk.Label(right_frame, text="Пользователи", fg="#ecf0f1", bg="#34495e", font=("Arial", 12))
-        self.user_label.grid(row=2, column=0, sticky="w", pady=5)
+        self.user_label.grid(row=3, column=0, sticky="w", pady=5)
 
         self.user_listbox = tk.Listbox(right_frame, height=6, font=("Arial", 12), bd=2, relief="solid")
-        self.user_listbox.grid(row=3, column=0, pady=5, sticky="nsew")
+        self.user_listbox.grid(row=4, column=0, pady=5, sticky="nsew")
         self.user_listbox.bind("<ButtonRelease-1>", self.on_user_selected)
+        self.users.attach(self.user_listbox)
 
         create_group_button = tk.Button(
             right_frame, text="Создать группу", font=("Arial", 12),
             bg="#3498db", fg="#fff", relief="raised", bd=5,
             command=self.create_group
         )
-        create_group_button.grid(row=4, column=0, pady=5)
+        create_group_button.grid(row=5, column=0, pady=5)
         invite_button = tk.Button(
             right_frame, text="Пригласить в группу", font=("Arial", 12),
             bg="#f39c12", fg="#fff", relief="raised", bd=5,
             command=self.invite_to_group
         )
-        invite_button.grid(row=5, column=0, pady=5)
+        invite_button.grid(row=6, column=0, pady=5)
+        history_button = tk.Button(
+            right_frame, text="Загрузить историю", font=("Arial", 12),
+            bg="#7f8c8d", fg="#fff", relief="raised", bd=5,
+            command=self.load_older_history
+        )
+        history_button.grid(row=7, column=0, pady=5)
 
+        self.entry_msg.bind("<Tab>", self.on_tab_pressed)
         self.entry_msg.bind("<Up>", self.navigate_history_up)
         self.entry_msg.bind("<Down>", self.navigate_history_down)
         self.chat_window.protocol("WM_DELETE_WINDOW", self.on_closing)
@@ -225,19 +335,23 @@ class ChatClient:
         self.chat_window.grid_rowconfigure(0, weight=1)
         self.chat_window.grid_columnconfigure(0, weight=1)
         self.chat_window.grid_columnconfigure(1, weight=0)
-        threading.Thread(target=self.listen_for_messages, daemon=True).start()
+        self.net.listen()
+        self.chat_window.after(RENDER_INTERVAL, self.render)
         self.chat_window.mainloop()
 
+    def send_frame(self, message):
+        """Отправляет одно сообщение серверу отдельным кадром."""
+        self.net.send(message)
+
+    def deliver(self, msg, control, message_id):
+        """Вызывается сетевым потоком: кадр попадает в очередь вывода, окно не трогается."""
+        self.inbox.put((msg, control, message_id))
+
     def on_closing(self):
         """Обработчик закрытия окна."""
         if self.is_connected:
-            try:
-                self.socket.send("CLOSE".encode())
-            except Exception as e:
-                print(f"Ошибка при отправке CLOSE: {e}")
-            finally:
-                self.socket.close()
-                self.is_connected = False
+            self.net.close("CLOSE")
+            self.is_connected = False
         self.chat_window.destroy()
 
     def navigate_history_up(self, event):
@@ -261,7 +375,7 @@ class ChatClient:
         group_name = simpledialog.askstring("Создание группы", "Введите название группы:")
         if group_name:
             try:
-                self.socket.send(f"/create_group {group_name}".encode())
+                self.send_frame(f"/create_group {group_name}")
             except:
                 messagebox.showerror("Ошибка", "Не удалось отправить запрос на сервер.")
 
@@ -289,7 +403,7 @@ class ChatClient:
                 return
 
             try:
-                self.socket.send(f"/invite {group_name} {user_name}".encode())
+                self.send_frame(f"/invite {group_name} {user_name}")
                 messagebox.showinfo("Приглашение", f"{user_name} приглашён в {group_name}.")
                 invite_window.destroy()  # Закрываем окно после успешного приглашения
             except:
@@ -312,6 +426,12 @@ class ChatClient:
 
         invite_window.mainloop()
 
+    def on_search_changed(self, *args):
+        """Фильтрация списков групп и пользователей по мере ввода."""
+        query = self.search_query.get().strip()
+        self.groups.set_query(query)
+        self.users.set_query(query)
+
     def on_group_selected(self, event):
         """Обработчик выбора группы для отправки сообщения."""
         selected_group = self.group_listbox.get(self.group_listbox.curselection())
@@ -348,7 +468,7 @@ class ChatClient:
                 else:
                     msg = f"/p {self.selected_recipient} {msg}"
             try:
-                self.socket.send(msg.encode())
+                self.send_frame(msg)
                 if self.selected_recipient:
                     parts = msg.split(" ", 2)
 
@@ -365,82 +485,199 @@ class ChatClient:
             except:
                 messagebox.showerror("Ошибка", "Соединение с сервером потеряно.")
 
+    def completion_target(self):
+        """(что дописывается, начатое слово) для строки ввода или None, если дополнять нечего."""
+        words = self.entry_msg.get().split(" ")
+        kind = COMPLETIONS.get((words[0], len(words)))
+        return (kind, words[-1]) if kind is not None else None
+
+    def on_tab_pressed(self, event):
+        """Автодополнение адресата команды: поиск на сервере, ответ придёт служебным search."""
+        target = self.completion_target()
+        if target is not None and target[1]:
+            try:
+                self.send_frame(f"/search {target[1]}")
+            except ConnectionError:
+                pass
+        return "break"
+
+    def complete(self, payload):
+        """Подстановка найденного имени или общего начала; несколько вариантов показываются в чате."""
+        target = self.completion_target()
+        if target is None or target[1] != payload.get("prefix"):
+            return  # строку успели изменить
+        kind, prefix = target
+        names = payload.get(kind, [])
+        if not names:
+            return
+        completion = names[0] + " " if len(names) == 1 else os.path.commonprefix(names)
+        if len(completion) > len(prefix):
+            text = self.entry_msg.get()
+            self.entry_msg.delete(0, tk.END)
+            self.entry_msg.insert(0, text[:len(text) - len(prefix)] + completion)
+        if len(names) > 1:
+            self.display_message("Варианты: " + ", ".join(names))
+
     def on_enter_pressed(self, event):
         """Обработчик нажатия клавиши Enter."""
         self.send_message()
 
-    def listen_for_messages(self):
-        """Слушает входящие сообщения от сервера."""
-        while self.is_connected:
-            try:
-                msg = self.socket.recv(1024).decode()
-                if not msg:
-                    break
-
-                if msg.startswith("update_groups"):
-                    # groups = msg.split(" ", 1)[1].split(",")
-                    response = requests.get(f"{base_url}/update_groups", params={'nickname': self.nickname})
-                    if response.status_code == 200:
-                        data = response.json()
-                        groups = data.get("update_groups", [])
-                        self.update_group_list(groups)
-
-                elif msg.startswith("update_users"):
-                    # users = msg.split(" ", 1)[1].split(",")
-                    response = requests.get(f"{base_url}/update_users", params={'nickname': self.nickname})
-                    if response.status_code == 200:
-                        data = response.json()
-                        users = data.get("update_users", [])
-                        self.update_user_list(users)
+    def apply_control(self, kind, payload):
+        """Применяет снимок или изменение списков пользователей и групп, присланные сервером."""
+        version = payload.get("version")
+        if kind == "resume":
+            # Сессия истекла - обычный вход под тем же ником; его история заменит показанную.
+            self.oldest_message_id = None
+            self.has_more_history = False
+            self.send_frame(self.nickname)
+        elif kind == "missed":
+            self.apply_missed(payload)
+        elif kind == "search":
+            self.complete(payload)
+        elif kind == "error":
+            if payload.get("code") == "rate_limited":
+                self.display_message(f"Слишком много сообщений, подождите {payload['retry_after']} с.")
+        elif kind == "roster_snapshot":
+            self.roster_version = version
+            self.update_user_list([user for user in payload.get("users", []) if user != self.nickname])
+        elif kind == "groups_snapshot":
+            self.groups_version = version
+            self.update_group_list(payload.get("groups", []))
+        elif kind == "history":
+            self.apply_history(payload)
+        elif kind == "roster_delta":
+            if self.roster_version is None or version <= self.roster_version:
+                return
+            if version != self.roster_version + 1:
+                self.refresh_users()
+                return
+            self.roster_version = version
+            self.users.update([user for user in payload["added"] if user != self.nickname], payload["removed"])
+        elif kind == "groups_delta":
+            if self.groups_version is None or version <= self.groups_version:
+                return
+            if version != self.groups_version + 1:
+                self.refresh_groups()
+                return
+            self.groups_version = version
+            self.groups.update(payload["added"], payload["removed"])
 
-                else:
-                    self.display_message(msg)
-            except:
-                self.is_connected = False
-                self.socket.close()
+    def render(self):
+        """Разбор входящих в цикле Tk по таймеру: накопившиеся сообщения выводятся одной вставкой."""
+        for _ in range(RENDER_BATCH):
+            try:
+                msg, control, message_id = self.inbox.get_nowait()
+            except queue.Empty:
                 break
+            if control:
+                self.apply_control(*control)
+            else:
+                self.display_message(msg, message_id)
+        self.flush_messages()
+        self.chat_window.after(RENDER_INTERVAL, self.render)
+
+    def apply_missed(self, payload):
+        """Показывает сообщения, пропущенные за время обрыва связи."""
+        for message in payload.get("messages", []):
+            self.display_message(message_text(message), message["id"])
+
+    def apply_history(self, payload):
+        """Показывает страницу истории: последнюю - вместо всего показанного, более ранние - над ним.
+
+        Последняя страница общего чата (без before) приходит при входе, в том числе повторном после
+        истёкшей сессии, и при пересинхронизации: старое содержимое окна и курсор подгрузки к ней не относятся.
+        """
+        messages = payload.get("messages", [])
+        self.has_more_history = payload.get("more", False)
+        if payload.get("before") is None and payload.get("channel") == "global":
+            self.clear_messages()
+            self.oldest_message_id = messages[0]["id"] if messages else None
+            for message in messages:
+                self.display_message(message_text(message), message["id"])
+            return
+        if not messages:
+            return
+        self.oldest_message_id = messages[0]["id"]
+        texts = [message_text(message) for message in messages]
+        for message, text in zip(reversed(messages), reversed(texts)):
+            lines = text.count("\n") + 1
+            self.rendered.appendleft((message["id"], lines))
+            self.line_count += lines
+        self.text_area.config(state="normal")
+        self.text_area.insert("1.0", "".join(text + "\n" for text in texts))
+        self.text_area.config(state="disabled")
 
-    def display_message(self, msg):
-        """Выводит сообщение в чат."""
+    def clear_messages(self):
+        """Очищает окно чата и ещё не выведенные сообщения."""
+        self.pending = []
+        self.rendered.clear()
+        self.line_count = 0
         self.text_area.config(state="normal")
-        self.text_area.insert(tk.END, msg + "\n")
+        self.text_area.delete("1.0", tk.END)
+        self.text_area.config(state="disabled")
+
+    def load_older_history(self):
+        """Запрашивает у сервера предыдущую страницу общего чата."""
+        if self.oldest_message_id is None or not self.has_more_history:
+            return
+        try:
+            self.send_frame(f"/history global {self.oldest_message_id}")
+        except:
+            messagebox.showerror("Ошибка", "Соединение с сервером потеряно.")
+
+    def refresh_users(self):
+        """Полная пересинхронизация списка пользователей через HTTP (при пропуске версии).
+
+        Запрос идёт в сетевом потоке; ответ придёт снимком roster_snapshot через очередь вывода.
+        """
+        self.net.refresh('users', self.nickname)
+
+    def refresh_groups(self):
+        """Полная пересинхронизация списка групп через HTTP (при пропуске версии)."""
+        self.net.refresh('groups', self.nickname)
+
+    def display_message(self, msg, message_id=None):
+        """Ставит сообщение в очередь вывода; в окне оно появится при ближайшем render."""
+        self.pending.append((message_id, msg))
+
+    def flush_messages(self):
+        """Выводит ожидающие сообщения одной вставкой и удаляет из окна строки сверх MAX_LINES."""
+        if not self.pending:
+            return
+        for message_id, msg in self.pending:
+            lines = msg.count("\n") + 1
+            self.rendered.append((message_id, lines))
+            self.line_count += lines
+        text = "".join(msg + "\n" for _, msg in self.pending)
+        self.pending = []
+        self.text_area.config(state="normal")
+        self.text_area.insert(tk.END, text)
+        self.trim_messages()
         self.text_area.config(state="disabled")
         self.text_area.yview(tk.END)
 
+    def trim_messages(self):
+        """Удаляет самые старые сообщения целиком, пока в окне больше MAX_LINES строк."""
+        removed = 0
+        while self.line_count - removed > MAX_LINES and len(self.rendered) > 1:
+            removed += self.rendered.popleft()[1]
+        if not removed:
+            return
+        self.line_count -= removed
+        self.text_area.delete("1.0", f"{removed + 1}.0")
+        # Подгрузка истории продолжится с самого старого из оставшихся сообщений.
+        oldest = next((message_id for message_id, _ in self.rendered if message_id is not None), None)
+        if oldest is not None:
+            self.oldest_message_id = oldest
+            self.has_more_history = True
+
     def update_group_list(self, groups):
-        """Обновляет список групп на клиенте."""
-        self.groups = groups
-        self.group_listbox.delete(0, tk.END)
-        for group in self.groups:
-            self.group_listbox.insert(tk.END, group)
+        """Обновляет список групп на клиенте: в listbox вносится только разница."""
+        self.groups.replace(groups)
 
     def update_user_list(self, users):
-        """Обновляет список пользователей."""
-        self.users = users
-        self.user_listbox.delete(0, tk.END)
-        for user in self.users:
-            self.user_listbox.insert(tk.END, user)
-
-    def start(self):
-        """Запуск клиента."""
-        self.socket.connect((self.host, self.port))
-        print(f"Подключено к серверу {self.host}:{self.port}")
-
-        # Ввод никнейма
-        while not self.nickname:
-            self.nickname = input("Введите никнейм: ")
-            self.socket.send(self.nickname.encode())
-            response = self.socket.recv(1024).decode()
-            if "занят" in response:
-                print(response)
-                self.nickname = None
-            else:
-                print("Вы вошли в чат.")
-
-        receive_thread = threading.Thread(target=self.receive_messages, daemon=True)
-        receive_thread.start()
-
-        self.send_message()
+        """Обновляет список пользователей: в listbox вносится только разница."""
+        self.users.replace(users)
 
 
 if __name__ == "__main__":
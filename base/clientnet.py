@@ -0,0 +1,240 @@
+"""Сетевое ядро GUI-клиента: цикл asyncio в фоновом потоке.
+
+В одном цикле работают сокет чата и одно keep-alive соединение с HTTP API, поэтому медленный
+HTTP-запрос не задерживает приём сообщений. Разобранные кадры и ответы API передаются через
+deliver(msg, control, message_id) - GUI складывает их в свою очередь и выводит в цикле Tk;
+сетевой поток никогда не ждёт интерфейс. Повторные запросы одного и того же обновления, пока
+предыдущий ещё не выполнен, сливаются в один.
+"""
+import asyncio
+import json
+import threading
+from urllib.parse import urlencode, urlsplit
+
+from protocol import HEADER, FrameDecoder, decode_message, encode_frame, hello_message, resume_message
+
+RECONNECT_ATTEMPTS = 8
+CONNECT_TIMEOUT = 10
+HTTP_TIMEOUT = 10
+READ_SIZE = 64 * 1024
+
+# Обновления списков через HTTP: путь API, поле ответа и служебное сообщение, которым результат
+# передаётся в GUI.
+REFRESHES = {
+    'users': ('/update_users', 'update_users', 'roster_snapshot', 'users'),
+    'groups': ('/update_groups', 'update_groups', 'groups_snapshot', 'groups'),
+}
+
+
+class HttpSession:
+    """Одно keep-alive соединение с HTTP API; запросы идут по нему по очереди, ответы 304 берутся из кэша."""
+
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+        self.cache = {}  # {цель запроса: (ETag, данные)}
+
+    async def get_json(self, path, params=None):
+        """GET-запрос; (статус, разобранный JSON). Оборванное сервером соединение открывается заново."""
+        target = f'{path}?{urlencode(params)}' if params else path
+        async with self.lock:
+            for attempt in range(2):
+                try:
+                    return await asyncio.wait_for(self.exchange(target), HTTP_TIMEOUT)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    self.close()
+                    if attempt:
+                        raise
+                except asyncio.TimeoutError:
+                    self.close()
+                    raise
+
+    async def exchange(self, target):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        lines = [f'GET {target} HTTP/1.1', f'Host: {self.host}:{self.port}', 'Connection: keep-alive']
+        cached = self.cache.get(target)
+        if cached is not None:
+            lines.append(f'If-None-Match: {cached[0]}')
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        head = (await self.reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+        status = int(head[0].split(' ')[1])
+        headers = {}
+        for line in head[1:]:
+            if line:
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+        body = await self.reader.readexactly(int(headers.get('content-length', 0)))
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+        if status == 304 and cached is not None:
+            return 200, cached[1]
+        data = json.loads(body) if body else None
+        if status == 200 and 'etag' in headers:
+            self.cache[target] = (headers['etag'], data)
+        return status, data
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class ClientNetwork:
+    """Соединение GUI-клиента с сервером: чат, возвращение в сессию и HTTP API в одном цикле событий.
+
+    Методы без async вызываются из потока Tk; корутины запускаются через call().
+    """
+
+    def __init__(self, address, base_url, deliver):
+        self.address = address
+        self.deliver = deliver
+        self.loop = asyncio.new_event_loop()
+        self.http = None
+        self.reader = None
+        self.writer = None
+        self.closed = False
+        self.session = None  # токен сессии, выданный сервером при входе
+        self.last_message_id = 0  # id последнего полученного сообщения - для возвращения в сессию
+        self.versions = lambda: (None, None)  # версии списков пользователей и групп на клиенте
+        self.refreshing = {}  # {вид обновления: нужен ли ещё один запрос после текущего}
+        self.base_url = base_url
+        threading.Thread(target=self.loop.run_forever, name='client-network', daemon=True).start()
+
+    def call(self, coro, timeout=CONNECT_TIMEOUT):
+        """Выполнение корутины в сетевом цикле с ожиданием результата (для экрана входа)."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    async def connect(self):
+        """Подключение к чату. Возвращает приветствие сервера."""
+        self.http = HttpSession(self.base_url)
+        self.reader, self.writer = await asyncio.open_connection(*self.address)
+        return await self.read_greeting()
+
+    async def read_greeting(self):
+        (length,) = HEADER.unpack(await self.reader.readexactly(HEADER.size))
+        return decode_message(await self.reader.readexactly(length))[0]
+
+    def listen(self):
+        """Запуск приёма сообщений чата."""
+        asyncio.run_coroutine_threadsafe(self.receive(), self.loop)
+
+    def send(self, message):
+        """Отправка сообщения серверу. ConnectionError, если связи сейчас нет."""
+        writer = self.writer
+        if self.closed or writer is None or writer.is_closing():
+            raise ConnectionError('Нет соединения с сервером')
+        self.loop.call_soon_threadsafe(writer.write, encode_frame(message))
+
+    def refresh(self, kind, nickname):
+        """Полная пересинхронизация списка ('users' или 'groups') через HTTP; повторы сливаются."""
+        self.loop.call_soon_threadsafe(self.schedule_refresh, kind, nickname)
+
+    def schedule_refresh(self, kind, nickname):
+        if kind in self.refreshing:
+            # Запрос уже идёт: после него будет ровно ещё один, сколько бы повторов ни пришло.
+            self.refreshing[kind] = True
+            return
+        self.refreshing[kind] = False
+        self.loop.create_task(self.run_refresh(kind, nickname))
+
+    async def run_refresh(self, kind, nickname):
+        path, field, control, key = REFRESHES[kind]
+        try:
+            while True:
+                self.refreshing[kind] = False
+                try:
+                    status, data = await self.http.get_json(path, {'nickname': nickname})
+                except (OSError, asyncio.TimeoutError, ValueError) as e:
+                    print(f'Ошибка обновления {path}: {e}')
+                    break
+                if status == 200:
+                    self.deliver('', (control, {key: data.get(field, []), "version": data.get("version")}), None)
+                if not self.refreshing[kind]:
+                    break
+        finally:
+            del self.refreshing[kind]
+
+    async def receive(self):
+        """Приём кадров; при обрыве связи - возвращение в сессию без нового входа."""
+        decoder = FrameDecoder(raw=True)
+        while not self.closed:
+            try:
+                data = await self.reader.read(READ_SIZE)
+            except OSError:
+                data = b''
+            if not data:
+                if self.closed or not self.session or not await self.reconnect():
+                    break
+                decoder = FrameDecoder(raw=True)
+                continue
+            for frame in decoder.feed(data):
+                self.handle_frame(frame)
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+            self.deliver("Соединение с сервером потеряно.", None, None)
+
+    def handle_frame(self, frame):
+        msg, control, message_id = decode_message(frame)
+        if message_id is not None:
+            self.last_message_id = max(self.last_message_id, message_id)
+        if control:
+            kind, payload = control
+            if kind == 'welcome':
+                self.session = payload.get("session")
+            elif kind == 'resume':
+                self.session = None
+            elif kind in ('missed', 'history'):
+                if kind == 'history' and payload.get("before") is None and payload.get("channel") == 'global':
+                    # Вход или пересинхронизация, возможно через другой узел со своей нумерацией сообщений.
+                    self.last_message_id = 0
+                for message in payload.get("messages", []):
+                    self.last_message_id = max(self.last_message_id, message["id"])
+        self.deliver(msg, control, message_id)
+
+    async def reconnect(self):
+        """Переподключение с токеном сессии и id последнего сообщения; сервер досылает пропущенное."""
+        self.writer.close()
+        self.writer = None
+        for attempt in range(RECONNECT_ATTEMPTS):
+            await asyncio.sleep(min(0.5 * 2 ** attempt, 5))
+            if self.closed:
+                return False
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(*self.address), CONNECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError):
+                continue
+            try:
+                self.reader = reader
+                await self.read_greeting()  # приветствие с последними никнеймами
+                roster_version, groups_version = self.versions()
+                writer.write(encode_frame(hello_message()) + encode_frame(
+                    resume_message(self.session, self.last_message_id, roster_version, groups_version)))
+                self.writer = writer
+                return True
+            except (OSError, asyncio.IncompleteReadError):
+                writer.close()
+        return False
+
+    def close(self, farewell=None):
+        """Закрытие соединения (с прощальным сообщением серверу) и остановка сетевого цикла."""
+        try:
+            self.call(self.shutdown(farewell), timeout=2)
+        except Exception as e:
+            print(f"Ошибка при закрытии соединения: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def shutdown(self, farewell):
+        self.closed = True
+        if self.writer is not None and not self.writer.is_closing():
+            if farewell is not None:
+                self.writer.write(encode_frame(farewell))
+                await self.writer.drain()
+            self.writer.close()
+        if self.http is not None:
+            self.http.close()
@@ -0,0 +1,77 @@
+"""Маршрутизация команд клиента по таблице.
+
+Сообщение разбирается один раз: имя команды (до первого пробела) ищется в словаре, аргументы
+режутся ровно на столько частей, сколько нужно команде. Новая команда добавляется вызовом
+register, без правки цепочки условий; справка /help собирается из той же таблицы.
+"""
+import time
+
+from metrics import REGISTRY
+
+COMMAND_COUNT = REGISTRY.counter('chat_commands_total', 'Выполненные команды', ('command',))
+COMMAND_SECONDS = REGISTRY.histogram('chat_command_seconds', 'Время выполнения команд', ('command',))
+
+
+class Command:
+    """Разобранная команда: имя, части как у str.split с разбиением команды, исходный текст."""
+
+    __slots__ = ('name', 'parts', 'text')
+
+    def __init__(self, name, parts, text):
+        self.name = name
+        self.parts = parts
+        self.text = text
+
+
+class CommandSpec:
+    __slots__ = ('name', 'handler', 'maxsplit', 'usage', 'kind')
+
+    def __init__(self, name, handler, maxsplit, usage, kind):
+        self.name = name
+        self.handler = handler
+        self.maxsplit = maxsplit
+        self.usage = usage
+        self.kind = kind
+
+
+class CommandRouter:
+    """Таблица команд {имя: CommandSpec}; обработчик вызывается как handler(parts, *контекст)."""
+
+    def __init__(self):
+        self.commands = {}
+
+    def register(self, name, handler, maxsplit=None, usage=None, kind='command'):
+        """Регистрация команды.
+
+        maxsplit - сколько раз резать текст по пробелу (None - по любым пробельным символам без
+        ограничения); usage - строка справки; kind - вид сообщения для статистики.
+        """
+        self.commands[name] = CommandSpec(name, handler, maxsplit, usage, kind)
+
+    def parse(self, text):
+        """Command для известной команды или None."""
+        end = text.find(' ')
+        spec = self.commands.get(text if end < 0 else text[:end])
+        if spec is None:
+            return None
+        parts = text.split() if spec.maxsplit is None else text.split(' ', spec.maxsplit)
+        return Command(spec.name, parts, text)
+
+    def dispatch(self, text, *context):
+        """Разбор и выполнение команды с учётом числа и времени. Возвращает вид сообщения."""
+        started = time.perf_counter()
+        command = self.parse(text)
+        if command is None:
+            COMMAND_COUNT.inc('unknown')
+            return 'command'
+        spec = self.commands[command.name]
+        try:
+            spec.handler(command.parts, *context)
+        finally:
+            COMMAND_COUNT.inc(spec.name)
+            COMMAND_SECONDS.observe(time.perf_counter() - started, spec.name)
+        return spec.kind
+
+    def help(self):
+        """Справка по всем командам в порядке регистрации."""
+        return "Доступные команды:\n" + "\n".join(spec.usage for spec in self.commands.values() if spec.usage)
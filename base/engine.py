@@ -0,0 +1,211 @@
+"""Асинхронный режим сервера: все TCP-клиенты обслуживаются одним циклом событий."""
+import asyncio
+from collections import deque
+
+from outbound import READ_PAUSES
+from protocol import TEXT, FrameDecoder
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BACKLOG = 4096
+WRITE_BUFFER_HIGH = 256 * 1024
+
+
+class AsyncConnection:
+    """Соединение режима asyncio: очередь кадров опустошается в транспорт, пока тот не просит паузу."""
+
+    def __init__(self, transport, queue):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        self.queue = queue
+        self.paused = False
+        self.reading_paused = False
+        self.held = False  # вывод придержан, пока готовится ответ, который должен уйти первым
+        self.waiting = None  # Future ответа брокера; до него следующие сообщения клиента не обрабатываются
+        self.codec = TEXT  # кодирование кадров, согласованное с клиентом
+        self.bucket = None  # корзина ограничения частоты сообщений клиента
+        transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+
+    def push(self, data, key=None):
+        """Постановка кадра в очередь. Возвращает False, если клиент не успевает читать."""
+        if self.transport.is_closing():
+            return True
+        if not self.queue.push(data, key):
+            return False
+        self.flush()
+        if self.paused and not self.reading_paused and self.queue.backlogged():
+            # Клиент не успевает читать: перестаём принимать от него запросы, пока очередь не разгрузится.
+            self.reading_paused = True
+            READ_PAUSES.inc()
+            self.transport.pause_reading()
+        return True
+
+    def flush(self):
+        while not (self.paused or self.held):
+            batch = self.queue.pop_batch()
+            if not batch:
+                return
+            self.transport.write(batch)
+
+    def pause(self):
+        self.paused = True
+
+    def hold(self):
+        self.held = True
+
+    def release(self, frame):
+        """Отправка подготовленного кадра впереди очереди и возобновление вывода."""
+        self.held = False
+        if self.transport.is_closing():
+            return
+        if frame:
+            self.transport.write(frame)
+        self.flush()
+
+    def resume(self):
+        self.paused = False
+        self.flush()
+        if self.reading_paused and not self.queue.backlogged() and not self.transport.is_closing():
+            self.reading_paused = False
+            self.transport.resume_reading()
+
+    def close(self):
+        if self.transport.is_closing():
+            return
+        self.paused = False
+        self.flush()
+        self.transport.close()
+
+    def abort(self):
+        """Обрыв без дописывания: transport.close() ждал бы, пока нечитающий клиент заберёт буфер."""
+        self.queue.clear()
+        self.transport.abort()
+
+    def __repr__(self):
+        return f'<AsyncConnection {self.addr}>'
+
+
+class ChatProtocol(asyncio.Protocol):
+    """Протокол одного клиента: первое сообщение - никнейм, дальше - команды и текст."""
+
+    def __init__(self, server):
+        self.server = server
+        self.conn = None
+        self.addr = None
+        self.nickname = None
+        self.clean = False  # клиент попрощался CLOSE - сессию не сохраняем
+        self.lost = False
+        self.decoder = FrameDecoder()
+        self.inbox = deque()  # принятые, но ещё не обработанные сообщения
+
+    def connection_made(self, transport):
+        self.conn = AsyncConnection(transport, self.server.new_queue())
+        self.addr = transport.get_extra_info('peername')
+        print(f'Соединение установлено: {self.conn}, {self.addr}')
+        try:
+            self.server.greet(self.conn, self.addr)
+        except Exception as e:
+            print(f'Ошибка с клиентом {self.addr}: {e}')
+            self.conn.close()
+
+    def data_received(self, data):
+        try:
+            self.inbox.extend(self.decoder.feed(data))
+            self.process()
+        except Exception as e:
+            print(f'Ошибка с клиентом {self.addr}: {e}')
+            self.conn.close()
+
+    def process(self):
+        """Обработка накопленных сообщений по порядку; на запросе к брокеру - пауза до ответа."""
+        while self.inbox and self.conn.waiting is None:
+            if not self.message_received(self.inbox.popleft()):
+                self.clean = True
+                self.conn.close()
+                return
+        if self.conn.waiting is not None and not self.lost:
+            self.conn.transport.pause_reading()
+            self.conn.waiting.add_done_callback(self.answered)
+
+    def answered(self, waiting):
+        """Ответ брокера получен: результат входа применяется как у handshake, обработка продолжается."""
+        self.conn.waiting = None
+        try:
+            result = waiting.result()
+        except Exception as e:
+            print(f'Ошибка с клиентом {self.addr}: {e}')
+            self.conn.close()
+            return
+        if self.nickname is None and result is not None:
+            if result is False:
+                self.clean = True
+                self.conn.close()
+                return
+            self.nickname = result
+        if self.lost:
+            # Клиент ушёл, пока ждали брокера: вошедший пользователь выходит как при обрыве связи.
+            self.connection_lost(None)
+            return
+        if not self.conn.reading_paused:
+            self.conn.transport.resume_reading()
+        try:
+            self.process()
+        except Exception as e:
+            print(f'Ошибка с клиентом {self.addr}: {e}')
+            self.conn.close()
+
+    def message_received(self, msg):
+        """Обработка одного кадра. Возвращает False, если соединение нужно закрыть."""
+        if self.nickname is None:
+            nickname = self.server.handshake(self.conn, self.addr, msg)
+            if nickname is False:
+                return False
+            self.nickname = nickname
+            return True
+        return self.server.handle_message(self.nickname, msg, self.conn)
+
+    def pause_writing(self):
+        self.conn.pause()
+
+    def resume_writing(self):
+        self.conn.resume()
+
+    def connection_lost(self, exc):
+        self.lost = True
+        if self.nickname:
+            self.server.disconnect(self.nickname, self.conn, self.clean)
+            self.nickname = None
+
+
+def raise_fd_limit():
+    """Поднимает мягкий лимит открытых файлов до жёсткого, чтобы держать тысячи сокетов."""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as e:
+            print(f'Не удалось поднять лимит файловых дескрипторов: {e}')
+
+
+async def serve(server):
+    """Приём соединений на уже привязанном сокете сервера."""
+    loop = asyncio.get_running_loop()
+    server.call_soon = loop.call_soon_threadsafe
+    server.loop = loop
+    server.sessions.call_later = loop.call_later
+    tcp_server = await loop.create_server(lambda: ChatProtocol(server), sock=server.socket, backlog=BACKLOG)
+    if server.http_port is not None:
+        await server.api.listen('0.0.0.0', server.http_port)
+    async with tcp_server:
+        await tcp_server.serve_forever()
+
+
+def run(server):
+    """Запуск цикла событий для ChatServer."""
+    raise_fd_limit()
+    asyncio.run(serve(server))
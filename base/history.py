@@ -0,0 +1,181 @@
+"""Журнал сообщений с постраничной выдачей по каналам.
+
+Каналы: "global" - общий чат, "group:<имя>" - группа, "dm:<ник> <ник>" - личная переписка
+(ники в алфавитном порядке). Сообщения пишутся в SQLite фоновым писателем базы, а последние
+сообщения недавно активных каналов (не больше TAIL_CHANNELS, общий чат - всегда) держатся в памяти,
+поэтому свежие страницы отдаются без запросов к базе. Чтения из базы выполняются без общей
+блокировки и не должны вызываться из цикла событий.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+
+from protocol import GLOBAL
+
+TAIL_SIZE = 100
+TAIL_CHANNELS = 1000
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# Сообщения одной страницы (а также пропущенных и входящих) в JSON: вдвое меньше protocol.MAX_FRAME_SIZE.
+MAX_PAGE_BYTES = 512 * 1024
+# Длина ника или имени группы в UTF-8. В двоичной записи (protocol.RECORD) длины канала и отправителя -
+# 16-битные, а канал личной переписки содержит оба ника: запас с большим избытком.
+MAX_NAME_BYTES = 256
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS messages (
+           id INTEGER PRIMARY KEY,
+           channel TEXT NOT NULL,
+           kind TEXT NOT NULL,
+           sender TEXT,
+           body TEXT NOT NULL,
+           created REAL NOT NULL)''',
+    'CREATE INDEX IF NOT EXISTS messages_channel_id ON messages (channel, id)',
+)
+
+INSERT_MESSAGE = 'INSERT INTO messages (id, channel, kind, sender, body, created) VALUES (?, ?, ?, ?, ?, ?)'
+SELECT_PAGE = '''SELECT id, channel, kind, sender, body, created FROM messages
+                 WHERE channel = ? AND id < ? ORDER BY id DESC LIMIT ?'''
+SELECT_MAX_ID = 'SELECT MAX(id) FROM messages'
+
+
+def group_channel(group_name):
+    return f'group:{group_name}'
+
+
+def dm_channel(first, second):
+    return 'dm:' + ' '.join(sorted((first, second)))
+
+
+def valid_name(name):
+    """Имя группы не длиннее MAX_NAME_BYTES: иначе сообщения её канала не уложатся в запись."""
+    return bool(name) and len(name.encode()) <= MAX_NAME_BYTES
+
+
+def valid_nickname(nickname):
+    """Ник без пробельных символов (пробел разделяет ники в имени личного канала) и не длиннее MAX_NAME_BYTES."""
+    return valid_name(nickname) and not any(char.isspace() for char in nickname)
+
+
+def to_dict(record):
+    message_id, channel, kind, sender, body, created = record
+    return {"id": message_id, "channel": channel, "kind": kind, "sender": sender, "body": body, "ts": created}
+
+
+def to_dicts(records, newest=False, max_bytes=MAX_PAGE_BYTES):
+    """Сообщения записей по порядку, пока их JSON укладывается в max_bytes (хотя бы одно).
+
+    newest - отбрасываются самые ранние записи (страница истории), иначе - самые поздние (пропущенное).
+    """
+    messages = []
+    size = 0
+    for record in reversed(records) if newest else records:
+        message = to_dict(record)
+        size += len(json.dumps(message, ensure_ascii=False).encode())
+        if messages and size > max_bytes:
+            break
+        messages.append(message)
+    if newest:
+        messages.reverse()
+    return messages
+
+
+class HistoryStore:
+    """Постоянный журнал сообщений: идентификаторы выдаются сразу, запись в базу - пачками."""
+
+    def __init__(self, db, tail_size=TAIL_SIZE, tail_channels=TAIL_CHANNELS):
+        self.db = db
+        self.tail_size = tail_size
+        self.tail_channels = tail_channels
+        self.lock = threading.Lock()
+        db.init_schema(SCHEMA)
+        self.last_id = db.query(SELECT_MAX_ID)[0][0] or 0
+        self.tails = OrderedDict()  # {channel: deque(последних записей)} от давно не использованных к недавним
+        self.loading = {}  # {channel: записи, добавленные, пока хвост канала читается из базы}
+        self._tail(GLOBAL)
+
+    def append(self, channel, kind, sender, body):
+        """Добавление сообщения. Возвращает запись (id, channel, kind, sender, body, created)."""
+        with self.lock:
+            self.last_id += 1
+            record = (self.last_id, channel, kind, sender, body, time.time())
+            tail = self.tails.get(channel)
+            if tail is not None:
+                tail.append(record)
+                self.tails.move_to_end(channel)
+            elif channel in self.loading:
+                self.loading[channel].append(record)
+        self.db.execute_later(INSERT_MESSAGE, record)
+        return record
+
+    def page(self, channel, before=None, limit=PAGE_SIZE):
+        """Сообщения канала с id < before (или последние), не больше limit, по возрастанию id."""
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        tail = self._tail(channel)
+        records = [record for record in tail if before is None or record[0] < before][-limit:]
+        if len(records) < limit and len(tail) == self.tail_size:
+            # Более старые сообщения есть только в базе; дожидаемся записи очереди, чтобы не было дыр.
+            self.db.flush()
+            oldest = records[0][0] if records else before
+            records = self._select(channel, oldest, limit - len(records))[::-1] + records
+        return records
+
+    def missed(self, nickname, channels, after, until, limit):
+        """Пропущенное пользователем: каналы channels и его личные переписки без его собственных сообщений.
+
+        Сообщения с after < id <= until по возрастанию, не больше limit.
+        """
+        self.db.flush()
+        placeholders = ', '.join('?' * len(channels))
+        # Личный канал "dm:<ник> <ник>": пользователь - первый или второй ник (ники без пробелов).
+        first, second = f'dm:{nickname} ', f' {nickname}'
+        sql = (f'SELECT id, channel, kind, sender, body, created FROM messages '
+               f'WHERE id > ? AND id <= ? AND sender IS NOT ? AND (channel IN ({placeholders}) '
+               f'OR substr(channel, 1, ?) = ? OR (substr(channel, 1, 3) = \'dm:\' AND substr(channel, -?) = ?)) '
+               f'ORDER BY id LIMIT ?')
+        params = (after, until, nickname, *channels, len(first), first, len(second), second, limit)
+        return [tuple(row) for row in self.db.query(sql, params)]
+
+    def between(self, channels, after, until, limit):
+        """Сообщения заданных каналов с after < id <= until по возрастанию, не больше limit."""
+        if not channels:
+            return []
+        self.db.flush()
+        placeholders = ', '.join('?' * len(channels))
+        sql = (f'SELECT id, channel, kind, sender, body, created FROM messages '
+               f'WHERE channel IN ({placeholders}) AND id > ? AND id <= ? ORDER BY id LIMIT ?')
+        return [tuple(row) for row in self.db.query(sql, (*channels, after, until, limit))]
+
+    def _tail(self, channel):
+        """Копия хвоста канала; если его нет в памяти, он читается из базы без удержания self.lock.
+
+        Записи, добавленные во время чтения, собираются в self.loading и дописываются к прочитанному.
+        """
+        with self.lock:
+            tail = self.tails.get(channel)
+            if tail is not None:
+                self.tails.move_to_end(channel)
+                return list(tail)
+            self.loading.setdefault(channel, [])
+        self.db.flush()
+        rows = self._select(channel, None, self.tail_size)
+        with self.lock:
+            added = self.loading.pop(channel, ())
+            tail = self.tails.get(channel)
+            if tail is None:
+                newest = rows[0][0] if rows else 0
+                tail = self.tails[channel] = deque(reversed(rows), maxlen=self.tail_size)
+                tail.extend(record for record in added if record[0] > newest)
+                self._evict()
+            return list(tail)
+
+    def _evict(self):
+        """Вытеснение хвостов давно не использованных каналов, кроме общего (вызывать под self.lock)."""
+        while len(self.tails) > self.tail_channels:
+            channel = next(channel for channel in self.tails if channel != GLOBAL)
+            del self.tails[channel]
+
+    def _select(self, channel, before, limit):
+        rows = self.db.query(SELECT_PAGE, (channel, before if before is not None else self.last_id + 1, limit))
+        return [tuple(row) for row in rows]
@@ -0,0 +1,217 @@
+"""HTTP API сервера чата на asyncio: GET-маршруты, keep-alive, кэш ответов и ETag/304.
+
+Обработчики выполняются в цикле событий и читают состояние чата по неизменяемым снимкам, без
+блокировок. В режиме asyncio API работает в том же цикле, что и чат, в режиме threads - в своём
+цикле в фоновом потоке. У маршрута может быть функция версии: пока версия не изменилась, ответ
+берётся из кэша, а клиент с совпадающим If-None-Match получает 304 без тела.
+"""
+import asyncio
+import hashlib
+import json
+import secrets
+import threading
+from collections import OrderedDict
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlsplit
+
+from metrics import REGISTRY
+
+MAX_HEADER = 16 * 1024
+KEEPALIVE_TIMEOUT = 30
+CACHE_SIZE = 4096
+JSON_TYPE = 'application/json'
+
+HTTP_REQUESTS = REGISTRY.counter('chat_http_requests_total', 'Запросы HTTP API', ('path', 'status'))
+HTTP_SECONDS = REGISTRY.histogram('chat_http_seconds', 'Время обработки запросов HTTP API', ('path',))
+
+
+class Request:
+    """Разобранный запрос: метод, путь, параметры строки запроса, заголовки (имена в нижнем регистре)
+    и адрес клиента, каким его видит сервер."""
+
+    __slots__ = ('method', 'path', 'query', 'args', 'headers', 'version', 'peer')
+
+    def __init__(self, method, target, version, headers, peer=None):
+        parts = urlsplit(target)
+        self.method = method
+        self.path = parts.path
+        self.query = parts.query
+        self.args = dict(parse_qsl(parts.query))
+        self.version = version
+        self.headers = headers
+        self.peer = peer
+
+    def arg_int(self, name, default=None):
+        """Целочисленный параметр; default, если его нет или он не число."""
+        try:
+            return int(self.args[name])
+        except (KeyError, ValueError):
+            return default
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+
+class Response:
+    __slots__ = ('status', 'body', 'content_type', 'etag')
+
+    def __init__(self, body, status=200, content_type=JSON_TYPE, etag=None):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.etag = etag
+
+    def encode(self, keep_alive, head_only=False, not_modified=False):
+        """Ответ целиком в байтах: строка статуса, заголовки и тело."""
+        status = HTTPStatus.NOT_MODIFIED if not_modified else HTTPStatus(self.status)
+        body = b'' if not_modified else self.body
+        lines = [f'HTTP/1.1 {status.value} {status.phrase}']
+        if not not_modified:
+            lines.append(f'Content-Type: {self.content_type}')
+            lines.append(f'Content-Length: {len(body)}')
+        if self.etag is not None:
+            lines.append(f'ETag: {self.etag}')
+            lines.append('Cache-Control: no-cache')
+        lines.append('Connection: ' + ('keep-alive' if keep_alive else 'close'))
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        return head if head_only else head + body
+
+
+def json_response(payload, status=200):
+    return Response(json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode(), status)
+
+
+def text_response(text, content_type):
+    return Response(text.encode(), content_type=content_type)
+
+
+def body_etag(body):
+    return '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+
+
+class Route:
+    __slots__ = ('handler', 'version', 'blocking')
+
+    def __init__(self, handler, version, blocking):
+        self.handler = handler
+        self.version = version
+        self.blocking = blocking
+
+
+class HttpApi:
+    """Маршрутизатор и HTTP/1.1-сервер на потоках asyncio."""
+
+    def __init__(self, cache_size=CACHE_SIZE):
+        self.routes = {}  # {путь: Route}
+        self.cache = OrderedDict()  # {(путь, строка запроса): Response} - трогается только из цикла событий
+        self.cache_size = cache_size
+        # Метка запуска в ETag: версии состояния начинаются заново после перезапуска сервера.
+        self.token = secrets.token_hex(4)
+        self.server = None
+
+    def route(self, path, version=None, blocking=False):
+        """Регистрация GET-обработчика handler(request) -> Response.
+
+        version(request) - версия данных ответа (None - не кэшировать); blocking - обработчик
+        может ждать базу данных и выполняется в пуле потоков, а не в цикле событий.
+        """
+        def register(handler):
+            self.routes[path] = Route(handler, version, blocking)
+            return handler
+        return register
+
+    async def respond(self, request):
+        """Ответ на запрос; при неизменной версии данных - закэшированный."""
+        route = self.routes.get(request.path)
+        if route is None:
+            return json_response({"error": "Not found"}, 404)
+        if request.method not in ('GET', 'HEAD'):
+            return json_response({"error": "Method not allowed"}, 405)
+        version = route.version(request) if route.version is not None else None
+        key = (request.path, request.query)
+        if version is not None:
+            etag = f'"{self.token}-{version}"'
+            cached = self.cache.get(key)
+            if cached is not None and cached.etag == etag:
+                self.cache.move_to_end(key)
+                return cached
+        if route.blocking:
+            response = await asyncio.get_running_loop().run_in_executor(None, route.handler, request)
+        else:
+            response = route.handler(request)
+        if response.status == 200:
+            if version is not None:
+                response.etag = etag
+                self.cache[key] = response
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            else:
+                response.etag = body_etag(response.body)
+        return response
+
+    async def handle(self, request):
+        with HTTP_SECONDS.time(request.path if request.path in self.routes else 'unknown'):
+            try:
+                response = await self.respond(request)
+            except Exception as e:
+                print(f'Ошибка HTTP API {request.method} {request.path}: {e}')
+                response = json_response({"error": "Internal server error"}, 500)
+        not_modified = response.etag is not None and response.etag == request.headers.get('if-none-match')
+        HTTP_REQUESTS.inc(request.path if request.path in self.routes else 'unknown',
+                          304 if not_modified else response.status)
+        return response.encode(request.keep_alive, request.method == 'HEAD', not_modified)
+
+    async def client_connected(self, reader, writer):
+        """Соединение HTTP-клиента: запросы обрабатываются по очереди, пока клиент держит keep-alive."""
+        peer = writer.get_extra_info('peername')
+        try:
+            while True:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEPALIVE_TIMEOUT)
+                request = parse_request(head, peer)
+                length = int(request.headers.get('content-length', 0))
+                if length:
+                    await reader.readexactly(length)
+                writer.write(await self.handle(request))
+                await writer.drain()
+                if not request.keep_alive:
+                    break
+        except ValueError:
+            writer.write(json_response({"error": "Bad request"}, 400).encode(False))
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def listen(self, host, port):
+        """Запуск приёма HTTP-соединений в текущем цикле событий."""
+        self.server = await asyncio.start_server(self.client_connected, host, port, limit=MAX_HEADER)
+        return self.server
+
+    async def serve(self, host, port):
+        server = await self.listen(host, port)
+        async with server:
+            await server.serve_forever()
+
+    def start(self, host, port):
+        """Запуск API в собственном цикле событий в фоновом потоке."""
+        thread = threading.Thread(target=asyncio.run, args=(self.serve(host, port),), name='http-api', daemon=True)
+        thread.start()
+        return thread
+
+
+def parse_request(head, peer=None):
+    """Разбор строки запроса и заголовков. ValueError, если запрос некорректен."""
+    lines = head.decode('latin-1').split('\r\n')
+    method, target, version = lines[0].split(' ')
+    if not version.startswith('HTTP/1.'):
+        raise ValueError(f'Неподдерживаемая версия HTTP: {version}')
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+    return Request(method, target, version, headers, peer)
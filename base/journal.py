@@ -0,0 +1,115 @@
+"""Постоянное хранение групп: журнал изменений и периодические снимки в SQLite.
+
+Каждое изменение (создание группы, добавление и исключение участника) дописывается в журнал
+через фоновый писатель базы. Каждые SNAPSHOT_EVERY записей всё множество групп сжимается в один
+снимок, а журнал до него удаляется. При запуске загружается снимок и проигрывается хвост журнала.
+Операции журнала идемпотентны, поэтому снимок, захвативший часть более поздних изменений,
+при проигрывании не портится.
+"""
+import json
+import threading
+import zlib
+
+SNAPSHOT_EVERY = 10000
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS group_journal (
+           seq INTEGER PRIMARY KEY,
+           op TEXT NOT NULL,
+           group_name TEXT NOT NULL,
+           member TEXT NOT NULL)''',
+    '''CREATE TABLE IF NOT EXISTS group_snapshot (
+           id INTEGER PRIMARY KEY CHECK (id = 0),
+           seq INTEGER NOT NULL,
+           data BLOB NOT NULL)''',
+)
+
+INSERT_ENTRY = 'INSERT OR REPLACE INTO group_journal (seq, op, group_name, member) VALUES (?, ?, ?, ?)'
+SELECT_ENTRIES = 'SELECT op, group_name, member FROM group_journal WHERE seq > ? ORDER BY seq'
+SELECT_LAST_SEQ = 'SELECT MAX(seq), COUNT(*) FROM group_journal'
+SAVE_SNAPSHOT = 'INSERT OR REPLACE INTO group_snapshot (id, seq, data) VALUES (0, ?, ?)'
+SELECT_SNAPSHOT = 'SELECT seq, data FROM group_snapshot WHERE id = 0'
+TRIM_JOURNAL = 'DELETE FROM group_journal WHERE seq <= ?'
+
+
+def encode_snapshot(entries):
+    """Снимок из (группа, владелец, участники) в сжатый JSON."""
+    rows = [[name, owner, sorted(members)] for name, owner, members in entries]
+    return zlib.compress(json.dumps(rows, ensure_ascii=False, separators=(',', ':')).encode())
+
+
+def decode_snapshot(data):
+    return {name: (owner, set(members)) for name, owner, members in json.loads(zlib.decompress(data))}
+
+
+def apply_entry(groups, op, group_name, member):
+    """Проигрывание одной записи журнала над {группа: (владелец, участники)}."""
+    if op == 'create':
+        groups.setdefault(group_name, (member, {member}))
+    elif group_name in groups:
+        if op == 'add':
+            groups[group_name][1].add(member)
+        elif op == 'remove':
+            groups[group_name][1].discard(member)
+
+
+class GroupJournal:
+    """Журнал групп с номерами записей; source() отдаёт текущие группы для снимка."""
+
+    def __init__(self, db, snapshot_every=SNAPSHOT_EVERY):
+        self.db = db
+        self.snapshot_every = snapshot_every
+        self.source = None
+        self.lock = threading.Lock()
+        self.snapshotting = False
+        db.init_schema(SCHEMA)
+        last_seq, count = db.query(SELECT_LAST_SEQ)[0]
+        snapshot = db.query(SELECT_SNAPSHOT)
+        self.seq = max(last_seq or 0, snapshot[0][0] if snapshot else 0)
+        self.since_snapshot = count
+
+    def load(self):
+        """Группы после последнего запуска: снимок плюс хвост журнала. {группа: (владелец, участники)}."""
+        snapshot = self.db.query(SELECT_SNAPSHOT)
+        seq, groups = (snapshot[0][0], decode_snapshot(snapshot[0][1])) if snapshot else (0, {})
+        for op, group_name, member in self.db.query(SELECT_ENTRIES, (seq,)):
+            apply_entry(groups, op, group_name, member)
+        return groups
+
+    def record(self, op, group_name, member):
+        """Запись изменения ('create' с владельцем, 'add' или 'remove' с участником)."""
+        with self.lock:
+            self.seq += 1
+            self.db.execute_later(INSERT_ENTRY, (self.seq, op, group_name, member))
+            self.since_snapshot += 1
+            due = (self.source is not None and not self.snapshotting
+                   and self.since_snapshot >= self.snapshot_every)
+            if due:
+                self.snapshotting = True
+        if due:
+            self.snapshot()
+
+    def snapshot(self, background=True):
+        """Снимок текущих групп. Группы читаются сразу, сжатие и запись идут в отдельном потоке."""
+        with self.lock:
+            seq = self.seq
+            self.since_snapshot = 0
+        # Номер берётся до чтения групп: всё, что записано в журнал до него, в снимок уже попало.
+        entries = list(self.source())
+        if background:
+            threading.Thread(target=self.write_snapshot, args=(seq, entries), name='group-snapshot',
+                             daemon=True).start()
+        else:
+            self.write_snapshot(seq, entries)
+
+    def write_snapshot(self, seq, entries):
+        try:
+            self.db.execute_later(SAVE_SNAPSHOT, (seq, encode_snapshot(entries)))
+            self.db.execute_later(TRIM_JOURNAL, (seq,))
+        finally:
+            self.snapshotting = False
+
+    def close(self):
+        """Снимок при остановке, чтобы следующий запуск не проигрывал журнал."""
+        if self.source is not None and self.since_snapshot:
+            self.snapshot(background=False)
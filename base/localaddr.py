@@ -0,0 +1,73 @@
+"""Собственный IP-адрес узла с кэшированием.
+
+Адрес определяется один раз и хранится, пока не изменился набор сетевых интерфейсов
+(socket.if_nameindex - локальный системный вызов) и не истёк ADDRESS_TTL. Сначала адрес
+берётся у системы маршрутизации: connect у UDP-сокета пакетов не отправляет, а только выбирает
+исходящий интерфейс; без маршрута по умолчанию - адрес имени хоста, в крайнем случае 127.0.0.1.
+"""
+import socket
+import threading
+import time
+
+ADDRESS_TTL = 300
+# TEST-NET-1 (RFC 5737): адрес заведомо не используется, нужен только для выбора маршрута.
+PROBE_ADDRESS = ('192.0.2.1', 9)
+LOOPBACK = '127.0.0.1'
+
+
+def interfaces():
+    """Снимок сетевых интерфейсов для проверки, не сменилась ли сеть."""
+    try:
+        return tuple(socket.if_nameindex())
+    except (OSError, AttributeError):
+        return ()
+
+
+def resolve_local_ip():
+    """Определение адреса без кэша; сетевых запросов не делает."""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(PROBE_ADDRESS)
+            return s.getsockname()[0]
+    except OSError:
+        pass
+    try:
+        for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET):
+            if not info[4][0].startswith('127.'):
+                return info[4][0]
+    except OSError:
+        pass
+    return LOOPBACK
+
+
+class AddressCache:
+    """Кэш собственного адреса, сбрасываемый при смене интерфейсов или по времени."""
+
+    def __init__(self, ttl=ADDRESS_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.address = None
+        self.interfaces = None
+        self.resolved = 0.0
+
+    def get(self):
+        current = interfaces()
+        now = time.monotonic()
+        with self.lock:
+            if self.address is None or current != self.interfaces or now - self.resolved > self.ttl:
+                self.address = resolve_local_ip()
+                self.interfaces = current
+                self.resolved = now
+            return self.address
+
+    def invalidate(self):
+        with self.lock:
+            self.address = None
+
+
+LOCAL_ADDRESS = AddressCache()
+
+
+def local_ip():
+    """Собственный IP-адрес узла (из кэша)."""
+    return LOCAL_ADDRESS.get()
@@ -0,0 +1,178 @@
+"""Встроенные метрики сервера в текстовом формате Prometheus.
+
+Счётчики и гистограммы обновляются на горячих путях, поэтому стоят одну блокировку и
+несколько операций со списком; всё, что можно посчитать при опросе (глубины очередей,
+число соединений), снимается функциями-измерителями только в момент выдачи /metrics.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Границы корзин по умолчанию в секундах: от 50 мкс до 2.5 с.
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    """Монотонный счётчик с необязательными метками."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self.values = {}  # {значения меток: число}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            yield self.name + _labels(self.label_names, label_values), value
+
+
+class Gauge:
+    """Значение, вычисляемое функцией в момент опроса: {значения меток: число} или число."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, collect, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self.collect = collect
+
+    def samples(self):
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in sorted(values.items()):
+            yield self.name + _labels(self.label_names, label_values), value
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами; в выдаче корзины накопительные, как требует формат."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = {}  # {значения меток: [счётчики корзин..., +Inf, сумма]}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def time(self, *label_values):
+        return _Timer(self, label_values)
+
+    def samples(self):
+        with self.lock:
+            series = sorted((label_values, list(values)) for label_values, values in self.series.items())
+        bounds = self.buckets + (float('inf'),)
+        for label_values, values in series:
+            total = 0
+            for bound, count in zip(bounds, values):
+                total += count
+                yield self.name + '_bucket' + _labels(self.label_names, label_values, (('le', _number(bound)),)), total
+            yield self.name + '_sum' + _labels(self.label_names, label_values), values[-1]
+            yield self.name + '_count' + _labels(self.label_names, label_values), total
+
+
+class _Timer:
+    """Контекстный менеджер: время выполнения блока уходит в гистограмму."""
+
+    __slots__ = ('histogram', 'label_values', 'started')
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+
+class Registry:
+    """Набор метрик процесса и их выдача одним текстом."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """Регистрация метрики; повторная регистрация имени возвращает уже существующую."""
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if existing.kind != metric.kind:
+                    raise ValueError(f'Метрика {metric.name} уже зарегистрирована как {existing.kind}')
+                return existing
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, collect, labels=()):
+        """Измеритель по функции; повторная регистрация заменяет функцию (например, при новом сервере)."""
+        gauge = self.register(Gauge(name, help_text, collect, labels))
+        gauge.collect = collect
+        return gauge
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def render(self):
+        """Все метрики в текстовом формате экспозиции Prometheus."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, value in metric.samples():
+                lines.append(f'{name} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
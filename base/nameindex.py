@@ -0,0 +1,64 @@
+"""Префиксный индекс имён для поиска и автодополнения.
+
+Имена хранятся отсортированным массивом пар (ключ без учёта регистра, имя). Поиск по префиксу -
+двоичный поиск начала диапазона и проход по k найденным: O(log n + префикс + k). Вставка и
+удаление сдвигают хвост массива одной операцией memmove, что для сотен тысяч имён быстрее
+дерева из объектов Python.
+"""
+import heapq
+import threading
+from bisect import bisect_left
+
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 200
+
+
+def search_key(name):
+    return name.casefold()
+
+
+def search_names(names, prefix, limit=SEARCH_LIMIT):
+    """До limit имён из небольшого набора (например, групп пользователя) с prefix, в порядке индекса."""
+    key = search_key(prefix)
+    entries = ((search_key(name), name) for name in names)
+    return [name for _, name in heapq.nsmallest(limit, (entry for entry in entries if entry[0].startswith(key)))]
+
+
+class PrefixIndex:
+    """Отсортированное множество имён с поиском по префиксу; методы потокобезопасны."""
+
+    def __init__(self, names=()):
+        self.entries = sorted({(search_key(name), name) for name in names})
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, name):
+        entry = (search_key(name), name)
+        with self.lock:
+            index = bisect_left(self.entries, entry)
+            if index == len(self.entries) or self.entries[index] != entry:
+                self.entries.insert(index, entry)
+
+    def discard(self, name):
+        entry = (search_key(name), name)
+        with self.lock:
+            index = bisect_left(self.entries, entry)
+            if index < len(self.entries) and self.entries[index] == entry:
+                del self.entries[index]
+
+    def search(self, prefix, limit=SEARCH_LIMIT):
+        """До limit имён, начинающихся с prefix без учёта регистра, по алфавиту."""
+        key = search_key(prefix)
+        found = []
+        with self.lock:
+            entries = self.entries
+            index = bisect_left(entries, (key,))
+            while index < len(entries) and len(found) < limit:
+                entry_key, name = entries[index]
+                if not entry_key.startswith(key):
+                    break
+                found.append(name)
+                index += 1
+        return found
@@ -0,0 +1,257 @@
+"""Исходящие очереди соединений и их опустошение без блокировки отправителя.
+
+Отправитель только кладёт готовый кадр в ограниченную очередь получателя,
+а записью в сокеты занимается слой ввода-вывода: поток OutboundPump в режиме
+threads или цикл событий в режиме asyncio.
+"""
+import selectors
+import socket
+import threading
+from collections import deque
+
+from metrics import REGISTRY
+from protocol import TEXT
+
+POLICIES = ('drop_oldest', 'coalesce', 'disconnect')
+MAX_FRAMES = 1024
+MAX_BYTES = 4 * 1024 * 1024
+BATCH_SIZE = 64 * 1024
+
+# На Linux/macOS пишем в блокирующий сокет без ожидания, не трогая его режим для потока чтения.
+SEND_FLAGS = getattr(socket, 'MSG_DONTWAIT', 0)
+
+SEND_ERRORS = REGISTRY.counter('chat_send_errors_total', 'Отказы доставки клиентам', ('reason',))
+READ_PAUSES = REGISTRY.counter('chat_read_pauses_total', 'Остановки чтения из-за полной исходящей очереди')
+
+
+class OutboundQueue:
+    """Ограниченная очередь исходящих кадров одного соединения.
+
+    При переполнении применяется политика медленного потребителя:
+    drop_oldest - выбросить самые старые кадры,
+    coalesce - сначала заменить устаревшие кадры с тем же ключом, затем выбросить старые,
+    disconnect - отказать, после чего соединение закрывается.
+    """
+
+    def __init__(self, policy='drop_oldest', max_frames=MAX_FRAMES, max_bytes=MAX_BYTES):
+        if policy not in POLICIES:
+            raise ValueError(f'Неизвестная политика очереди: {policy}')
+        self.policy = policy
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.entries = deque()  # [key, data, alive]
+        self.keyed = {}  # {key: entry}
+        self.count = 0
+        self.size = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def backlogged(self):
+        """Очередь заполнена наполовину: чтение от этого клиента пора приостановить."""
+        return self.count * 2 >= self.max_frames or self.size * 2 >= self.max_bytes
+
+    def push(self, data, key=None):
+        """Добавление кадра. Возвращает False, если соединение нужно отключить."""
+        with self.lock:
+            if key is not None and self.policy == 'coalesce' and key in self.keyed:
+                self._discard(self.keyed[key])
+            if self.count >= self.max_frames or self.size + len(data) > self.max_bytes:
+                if self.policy == 'disconnect':
+                    return False
+                while self.count and (self.count >= self.max_frames or self.size + len(data) > self.max_bytes):
+                    self._discard(self.entries[0])
+                    self._drop_dead()
+            entry = [key, data, True]
+            self.entries.append(entry)
+            if key is not None:
+                self.keyed[key] = entry
+            self.count += 1
+            self.size += len(data)
+            return True
+
+    def clear(self):
+        """Удаление всех кадров (соединение обрывается, дописывать нечего)."""
+        with self.lock:
+            self.entries.clear()
+            self.keyed.clear()
+            self.count = 0
+            self.size = 0
+
+    def pop_batch(self, limit=BATCH_SIZE):
+        """Извлечение нескольких кадров подряд одним буфером (не больше limit, но хотя бы один кадр)."""
+        with self.lock:
+            chunks = []
+            total = 0
+            self._drop_dead()
+            while self.entries and (not chunks or total + len(self.entries[0][1]) <= limit):
+                entry = self.entries.popleft()
+                key, data, _ = entry
+                if key is not None and self.keyed.get(key) is entry:
+                    del self.keyed[key]
+                chunks.append(data)
+                total += len(data)
+                self.count -= 1
+                self.size -= len(data)
+                self._drop_dead()
+            return b''.join(chunks)
+
+    def _discard(self, entry):
+        """Пометка кадра удалённым (сам элемент уходит из deque при извлечении)."""
+        if not entry[2]:
+            return
+        entry[2] = False
+        self.count -= 1
+        self.size -= len(entry[1])
+        self.dropped += 1
+        if entry[0] is not None and self.keyed.get(entry[0]) is entry:
+            del self.keyed[entry[0]]
+
+    def _drop_dead(self):
+        while self.entries and not self.entries[0][2]:
+            self.entries.popleft()
+
+
+class ThreadConnection:
+    """Соединение режима threads: поток клиента читает сокет, OutboundPump пишет в него."""
+
+    def __init__(self, sock, addr, pump, queue):
+        self.sock = sock
+        self.addr = addr
+        self.pump = pump
+        self.queue = queue
+        self.pending = None  # memoryview недописанного буфера
+        self.closed = False
+        self.aborted = False  # закрыть, не дописывая очередь
+        self.codec = TEXT  # кодирование кадров, согласованное с клиентом
+        self.bucket = None  # корзина ограничения частоты сообщений клиента
+        self.drained = threading.Event()
+
+    def push(self, data, key=None):
+        """Постановка кадра в очередь. Возвращает False, если клиент не успевает читать."""
+        if self.closed:
+            return True
+        if not self.queue.push(data, key):
+            return False
+        self.pump.schedule(self)
+        return True
+
+    def wait_drained(self):
+        """Поток чтения ждёт, пока исходящая очередь не разгрузится: новые запросы клиента не читаются."""
+        if not self.queue.backlogged():
+            return
+        READ_PAUSES.inc()
+        while not self.closed and self.queue.backlogged():
+            self.drained.wait(1)
+            self.drained.clear()
+
+    def flush(self):
+        """Запись накопленного без блокировки. Возвращает True, если очередь опустела."""
+        while True:
+            if self.aborted:
+                self.pending = None
+                return True
+            if not self.pending:
+                batch = self.queue.pop_batch()
+                if not batch:
+                    self.drained.set()
+                    return True
+                self.pending = memoryview(batch)
+            sent = self.sock.send(self.pending, SEND_FLAGS)
+            self.pending = self.pending[sent:]
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.drained.set()
+        self.pump.schedule(self)
+
+    def abort(self):
+        """Обрыв без дописывания очереди: клиент не читает, ждать его бессмысленно."""
+        self.aborted = True
+        self.queue.clear()
+        self.close()
+
+    def __repr__(self):
+        return f'<ThreadConnection {self.addr}>'
+
+
+class OutboundPump(threading.Thread):
+    """Единственный поток записи для всех соединений режима threads."""
+
+    def __init__(self):
+        super().__init__(name='outbound-pump', daemon=True)
+        self.selector = selectors.DefaultSelector()
+        self.ready = deque()
+        self.waiting = set()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+
+    def schedule(self, conn):
+        """Просьба записать очередь соединения (или закрыть его)."""
+        self.ready.append(conn)
+        try:
+            self.wake_w.send(b'\0')
+        except BlockingIOError:
+            pass
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.fileobj is self.wake_r:
+                    try:
+                        while self.wake_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self.forget(key.data)
+                    self.ready.append(key.data)
+            while self.ready:
+                self.service(self.ready.popleft())
+
+    def service(self, conn):
+        """Запись в одно соединение; если сокет занят - ждём готовности к записи."""
+        if conn in self.waiting and not conn.closed:
+            return
+        try:
+            drained = conn.flush()
+        except BlockingIOError:
+            drained = False
+        except OSError:
+            SEND_ERRORS.inc('write_error')
+            # Недописанное уже не доставить: при следующем обслуживании (после close()) повторять нечего.
+            conn.pending = None
+            conn.queue.clear()
+            self.forget(conn)
+            self.shutdown(conn)
+            # Сокет закрывает только его владелец; поток чтения увидит конец потока и вызовет close().
+            if conn.closed:
+                conn.sock.close()
+            return
+        if conn.closed:
+            self.forget(conn)
+            self.shutdown(conn)
+            conn.sock.close()
+        elif drained:
+            self.forget(conn)
+        elif conn not in self.waiting:
+            self.waiting.add(conn)
+            self.selector.register(conn.sock.fileno(), selectors.EVENT_WRITE, conn)
+
+    @staticmethod
+    def shutdown(conn):
+        try:
+            conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def forget(self, conn):
+        if conn in self.waiting:
+            self.waiting.discard(conn)
+            self.selector.unregister(conn.sock.fileno())
@@ -0,0 +1,270 @@
+"""Кадрирование сообщений TCP-протокола чата.
+
+Каждое сообщение передаётся кадром: 4 байта длины (big-endian) и тело. По умолчанию тело - текст
+в UTF-8. Клиент может до никнейма прислать "hello {"codec": "binary", "compress": true}", и тогда
+сервер шлёт ему двоичные кадры: первый байт - вид (TAG_*), дальше текст, служебное сообщение или
+запись журнала в упакованном виде. Крупные кадры при согласованном сжатии сжимаются zlib.
+Текстовые кадры начинаются с печатного символа, двоичные - с байта меньше 0x20, поэтому клиент
+различает их без отдельного переключения режима.
+"""
+import json
+import struct
+import zlib
+from collections import deque
+
+HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 1 << 20
+# Сообщение клиента в байтах UTF-8: с большим запасом меньше кадра, чтобы страницы истории из многих
+# сообщений не упирались в MAX_FRAME_SIZE.
+MAX_MESSAGE_SIZE = 16 * 1024
+RECV_SIZE = 65536
+
+GLOBAL = 'global'
+
+# Виды двоичных кадров.
+TAG_TEXT, TAG_RECORD, TAG_CONTROL, TAG_COMPRESSED = range(4)
+# Запись журнала после байта вида: kind, id, время, длины канала и отправителя; дальше канал, отправитель, текст.
+RECORD = struct.Struct('!BIdHH')
+RECORD_KINDS = ('system', 'chat')
+COMPRESS_MIN = 1024
+
+# Служебные сообщения сервера: "<вид> <json>". Клиенты применяют их к своему состоянию, а не показывают.
+CONTROL_KINDS = frozenset({'welcome', 'resume', 'error', 'history', 'missed', 'search', 'roster_snapshot',
+                           'roster_delta', 'groups_snapshot', 'groups_delta'})
+
+
+class ProtocolError(Exception):
+    """Нарушение формата кадров."""
+
+
+def encode_frame(message):
+    """Кодирование одного сообщения в кадр."""
+    data = message.encode()
+    return HEADER.pack(len(data)) + data
+
+
+def render_text(record):
+    """Текст сообщения журнала в том виде, в каком его показывают клиенты."""
+    _, channel, kind, sender, body, _ = record
+    if kind == 'system':
+        return body
+    if channel == GLOBAL:
+        return f'[{sender}] {body}'
+    if channel.startswith('group:'):
+        return f"[Группа {channel[6:]} | {sender}]: {body}"
+    return f"[ЛС от {sender}]: {body}"
+
+
+def message_text(message):
+    """Текст сообщения из страницы history или missed (см. history.to_dict)."""
+    return render_text((message["id"], message["channel"], message["kind"], message["sender"], message["body"],
+                        message["ts"]))
+
+
+def control_message(kind, payload):
+    """Служебное сообщение для клиента."""
+    return f'{kind} {json.dumps(payload, ensure_ascii=False, separators=(",", ":"))}'
+
+
+def parse_control(message):
+    """Разбор служебного сообщения. Возвращает (вид, данные) или None для обычного текста."""
+    kind, _, body = message.partition(' ')
+    if kind not in CONTROL_KINDS:
+        return None
+    try:
+        return kind, json.loads(body)
+    except ValueError:
+        return None
+
+
+def hello_message(binary=True, compress=True):
+    """Первое сообщение клиента, который хочет двоичные кадры."""
+    return control_message('hello', {"codec": "binary" if binary else "text", "compress": compress})
+
+
+def parse_hello(message):
+    """Кодек из сообщения hello или None, если это не hello."""
+    kind, _, body = message.partition(' ')
+    if kind != 'hello':
+        return None
+    try:
+        options = json.loads(body)
+    except ValueError:
+        return TEXT
+    if not isinstance(options, dict) or options.get('codec') != 'binary':
+        return TEXT
+    return BINARY_COMPRESSED if options.get('compress') else BINARY
+
+
+def resume_message(session, last_id, roster_version=None, groups_version=None):
+    """Просьба клиента вернуться в сессию вместо входа по никнейму."""
+    return control_message('resume', {"session": session, "last_id": last_id,
+                                      "roster_version": roster_version, "groups_version": groups_version})
+
+
+def parse_resume(message):
+    """Данные сообщения resume или None, если это не resume."""
+    kind, _, body = message.partition(' ')
+    if kind != 'resume':
+        return None
+    try:
+        request = json.loads(body)
+    except ValueError:
+        return {}
+    return request if isinstance(request, dict) else {}
+
+
+class Codec:
+    """Кодирование сообщений для соединений одного вида. Экземпляры - синглтоны, годятся в ключи кэшей."""
+
+    __slots__ = ('binary', 'compress')
+
+    def __init__(self, binary, compress):
+        self.binary = binary
+        self.compress = compress
+
+    def pack(self, tag, data):
+        payload = bytes((tag,)) + data
+        if self.compress and len(payload) >= COMPRESS_MIN:
+            payload = bytes((TAG_COMPRESSED,)) + zlib.compress(payload)
+        return HEADER.pack(len(payload)) + payload
+
+    def text(self, message):
+        """Кадр с текстом для показа."""
+        if not self.binary:
+            return encode_frame(message)
+        return self.pack(TAG_TEXT, message.encode())
+
+    def control(self, kind, payload):
+        """Кадр со служебным сообщением."""
+        message = control_message(kind, payload)
+        if not self.binary:
+            return encode_frame(message)
+        return self.pack(TAG_CONTROL, message.encode())
+
+    def record(self, record):
+        """Кадр с записью журнала (id, channel, kind, sender, body, created)."""
+        if not self.binary:
+            return encode_frame(render_text(record))
+        message_id, channel, kind, sender, body, created = record
+        channel = b'' if channel == GLOBAL else channel.encode()
+        sender = (sender or '').encode()
+        header = RECORD.pack(RECORD_KINDS.index(kind), message_id, created, len(channel), len(sender))
+        return self.pack(TAG_RECORD, header + channel + sender + body.encode())
+
+    def __repr__(self):
+        return f'<Codec binary={self.binary} compress={self.compress}>'
+
+
+TEXT = Codec(False, False)
+BINARY = Codec(True, False)
+BINARY_COMPRESSED = Codec(True, True)
+
+
+class Frames(dict):
+    """Кадры одного сообщения по кодекам: каждое кодирование строится один раз на рассылку."""
+
+    def __init__(self, build):
+        super().__init__()
+        self.build = build
+
+    def __missing__(self, codec):
+        frame = self[codec] = self.build(codec)
+        return frame
+
+
+def decode_record(data):
+    """Запись журнала из тела двоичного кадра (без байта вида)."""
+    kind, message_id, created, channel_size, sender_size = RECORD.unpack_from(data)
+    offset = RECORD.size
+    channel = data[offset:offset + channel_size].decode() or GLOBAL
+    offset += channel_size
+    sender = data[offset:offset + sender_size].decode() or None
+    body = data[offset + sender_size:].decode()
+    return message_id, channel, RECORD_KINDS[kind], sender, body, created
+
+
+def decode_message(data):
+    """Кадр сервера в байтах -> (текст, служебное сообщение (вид, данные) или None, id записи журнала или None)."""
+    if not data or data[0] >= 0x20:
+        text = bytes(data).decode()
+        return text, parse_control(text), None
+    tag, body = data[0], bytes(data[1:])
+    if tag == TAG_COMPRESSED:
+        return decode_message(zlib.decompress(body))
+    if tag == TAG_RECORD:
+        record = decode_record(body)
+        return render_text(record), None, record[0]
+    if tag == TAG_CONTROL:
+        text = body.decode()
+        return text, parse_control(text), None
+    if tag == TAG_TEXT:
+        return body.decode(), None, None
+    raise ProtocolError(f'Неизвестный вид кадра: {tag}')
+
+
+class FrameDecoder:
+    """Потоковый декодер: принимает куски байтов, возвращает целые сообщения (raw - байты без декодирования)."""
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, raw=False):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+        self.raw = raw
+
+    def feed(self, data):
+        """Добавление принятых байтов. Возвращает список завершённых сообщений.
+
+        Кадры читаются через memoryview прямо из принятого куска (или из буфера, если в нём
+        остался незаконченный кадр): текст декодируется без промежуточной копии байтов, в буфер
+        попадает только неполный хвост.
+        """
+        source = data
+        if self.buffer:
+            self.buffer += data
+            source = self.buffer
+        messages = []
+        offset = 0
+        with memoryview(source) as view:
+            size = len(view)
+            while size - offset >= HEADER.size:
+                (length,) = HEADER.unpack_from(view, offset)
+                if length > self.max_frame_size:
+                    raise ProtocolError(f'Слишком большой кадр: {length} байт')
+                end = offset + HEADER.size + length
+                if end > size:
+                    break
+                if self.raw:
+                    messages.append(bytes(view[offset + HEADER.size:end]))
+                else:
+                    messages.append(str(view[offset + HEADER.size:end], 'utf-8'))
+                offset = end
+        if source is self.buffer:
+            del self.buffer[:offset]
+        elif offset < len(data):
+            self.buffer += data[offset:]
+        return messages
+
+
+class FrameReader:
+    """Чтение кадров из блокирующего сокета по одному сообщению."""
+
+    def __init__(self, sock, raw=False):
+        self.sock = sock
+        self.decoder = FrameDecoder(raw=raw)
+        self.pending = deque()
+
+    def read(self):
+        """Следующее сообщение или None, если соединение закрыто."""
+        while not self.pending:
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                return None
+            self.pending.extend(self.decoder.feed(data))
+        return self.pending.popleft()
+
+    def __iter__(self):
+        while True:
+            message = self.read()
+            if message is None:
+                return
+            yield message
@@ -0,0 +1,80 @@
+"""Ограничение частоты сообщений: корзины токенов на соединение и на канал.
+
+Корзина соединения трогается только потоком (или циклом событий), читающим это соединение,
+поэтому обходится без блокировки. Корзины каналов общие для всех отправителей и защищены одной
+блокировкой. Нулевая скорость отключает ограничение.
+"""
+import threading
+import time
+
+from metrics import REGISTRY
+
+CLIENT_RATE = 10.0
+CLIENT_BURST = 20
+CHANNEL_RATE = 100.0
+CHANNEL_BURST = 200
+
+RATE_LIMITED = REGISTRY.counter('chat_rate_limited_total', 'Сообщения, отклонённые ограничением частоты', ('scope',))
+
+
+class TokenBucket:
+    """Корзина на burst токенов, пополняемая со скоростью rate токенов в секунду."""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now=None):
+        """Списание токена. Возвращает 0, если сообщение разрешено, иначе сколько секунд ждать."""
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Выдача корзин соединениям и проверка лимитов каналов."""
+
+    def __init__(self, client_rate=CLIENT_RATE, client_burst=CLIENT_BURST,
+                 channel_rate=CHANNEL_RATE, channel_burst=CHANNEL_BURST):
+        self.client_rate = client_rate
+        self.client_burst = max(1, client_burst)
+        self.channel_rate = channel_rate
+        self.channel_burst = max(1, channel_burst)
+        self.channels = {}  # {channel: TokenBucket}
+        self.lock = threading.Lock()
+
+    def client_bucket(self):
+        """Корзина нового соединения или None, если лимит на клиента отключён."""
+        if self.client_rate <= 0:
+            return None
+        return TokenBucket(self.client_rate, self.client_burst)
+
+    def check_client(self, bucket):
+        """Секунды до следующего разрешённого сообщения клиента (0 - можно сейчас)."""
+        if bucket is None:
+            return 0
+        wait = bucket.take()
+        if wait:
+            RATE_LIMITED.inc('client')
+        return wait
+
+    def check_channel(self, channel):
+        """Секунды до следующего разрешённого сообщения в канал (0 - можно сейчас)."""
+        if self.channel_rate <= 0:
+            return 0
+        with self.lock:
+            bucket = self.channels.get(channel)
+            if bucket is None:
+                bucket = self.channels[channel] = TokenBucket(self.channel_rate, self.channel_burst)
+            wait = bucket.take()
+        if wait:
+            RATE_LIMITED.inc('channel')
+        return wait
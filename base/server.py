@@ -1,181 +1,337 @@
+import argparse
+import multiprocessing
+import os
 import socket
-import sqlite3
 import threading
 import time
-
-from flask import Flask, request, jsonify
+from urllib.parse import urlsplit
+
+import engine
+from bus import DEFAULT_PORT as BUS_PORT, Broker, BrokerBus, LocalBus, make_bus
+from commands import CommandRouter
+from httpapi import HttpApi, json_response, text_response
+from journal import GroupJournal
+from localaddr import local_ip
+from history import (GLOBAL, MAX_NAME_BYTES, MAX_PAGE_SIZE, PAGE_SIZE, HistoryStore, dm_channel, group_channel,
+                     to_dicts, valid_name, valid_nickname)
+from metrics import CONTENT_TYPE, REGISTRY, SIZE_BUCKETS
+from nameindex import MAX_SEARCH_LIMIT, SEARCH_LIMIT
+from outbound import POLICIES, SEND_ERRORS, OutboundPump, OutboundQueue, ThreadConnection
+from ratelimit import CHANNEL_BURST, CHANNEL_RATE, CLIENT_BURST, CLIENT_RATE, RateLimiter
+from protocol import MAX_MESSAGE_SIZE, FrameReader, Frames, parse_hello, parse_resume
+from sessions import DetachedConnection, SessionTable, new_token
+from state import ChatState
+from storage import Database
+
+MODES = ('threads', 'asyncio')
+JOIN_SEQUENCE = ('history', 'roster_snapshot', 'groups_snapshot')
+RESUME_LIMIT = 1000
+INBOX_LIMIT = 1000
+
+MESSAGES = REGISTRY.counter('chat_messages_total', 'Сообщения клиентов по видам', ('kind',))
+BROADCAST_FANOUT = REGISTRY.histogram('chat_broadcast_fanout', 'Получателей одного сообщения общего чата',
+                                      buckets=SIZE_BUCKETS)
+GROUP_FANOUT = REGISTRY.histogram('chat_group_fanout', 'Получателей одного сообщения группы на узле',
+                                  buckets=SIZE_BUCKETS)
+BROADCAST_SECONDS = REGISTRY.histogram('chat_broadcast_seconds', 'Время рассылки сообщения общего чата')
 
 
 class ChatServer:
-    def __init__(self, host='', port=9090):
+    def __init__(self, host='', port=9090, mode='threads', outbound_policy='drop_oldest', bus=None,
+                 db_file='chat.db', http_port=5000, workers=1, reuse_port=False, rate_limits=None):
+        if mode not in MODES:
+            raise ValueError(f'Неизвестный режим сервера: {mode}')
+        if outbound_policy not in POLICIES:
+            raise ValueError(f'Неизвестная политика очереди: {outbound_policy}')
+        if workers < 1:
+            raise ValueError('Число рабочих процессов должно быть положительным')
+        if (workers > 1 or reuse_port) and not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError('SO_REUSEPORT не поддерживается этой платформой')
         self.host = host
         self.port = port
+        self.mode = mode
+        self.outbound_policy = outbound_policy
+        self.http_port = http_port
+        self.workers = workers
+        # Параметры RateLimiter: client_rate, client_burst, channel_rate, channel_burst.
+        self.rate_limits = rate_limits or {}
+        self.limiter = RateLimiter(**self.rate_limits)
+        self.pump = None
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.connections = {}  # {nickname: (address, socket)}
-        self.groups = {}  # {group_name: {"owner": "nick", "members": [nick1, nick2, ...]}}
-        self.recent_messages = []
-        self.db_file = 'chat.db'
-        self.init_db()
-
-        self.app = Flask(__name__)
+        if reuse_port:
+            # Порт делят рабочие процессы одного сервера; ядро распределяет между ними входящие соединения.
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.state = ChatState()
+        self.sessions = SessionTable()
+        # Шина кластера; события других узлов в режиме asyncio переносятся в цикл событий через call_soon.
+        self.bus = bus or LocalBus()
+        self.call_soon = None
+        self.loop = None  # цикл событий режима asyncio
+        self.bus_handlers = {
+            'sync': self.on_sync,
+            'join': self.on_join,
+            'leave': self.on_leave,
+            'resume': self.on_resume,
+            'global': self.on_global,
+            'private': self.on_private,
+            'deliver': self.on_deliver,
+            'group_create': self.on_group_create,
+            'group_add': self.on_group_add,
+            'group_remove': self.on_group_remove,
+            'group_msg': self.on_group_msg,
+        }
+        self.db_file = db_file
+        self.db = Database(self.db_file)
+        self.history = HistoryStore(self.db)
+        # Группы одиночного сервера переживают перезапуск; в кластере их хранит брокер.
+        self.group_journal = None
+        if not self.bus.clustered:
+            self.group_journal = GroupJournal(self.db)
+            self.state.restore_groups(self.group_journal.load())
+            self.group_journal.source = self.state.group_entries
+            self.state.journal = self.group_journal
+
+        self.api = HttpApi()
         self.setup_routes()
-
-    def get_connection(self):
-        """Получение нового соединения с базой данных."""
-        try:
-            conn = sqlite3.connect(self.db_file, timeout=10)
-            return conn
-        except sqlite3.OperationalError as e:
-            print(f"Ошибка при подключении к базе данных: {e}")
-            return None
-
-    def init_db(self):
-        """Создание таблицы в базе данных, если она еще не существует."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS nicknames (
-                                nickname TEXT PRIMARY KEY,
-                                ip_address TEXT)''')
-        conn.commit()
-        conn.close()
+        self.commands = CommandRouter()
+        self.setup_commands()
+        self.setup_metrics()
+
+    def setup_metrics(self):
+        """Измерители, которые считаются только при опросе /metrics."""
+        REGISTRY.gauge('chat_users_online', 'Пользователи в сети', lambda: len(self.state.users()))
+        REGISTRY.gauge('chat_groups', 'Число групп', lambda: len(self.state.groups))
+        REGISTRY.gauge('chat_outbound_queue_frames', 'Кадры в исходящих очередях: всего и в самой длинной',
+                       lambda: self.queue_depths(lambda queue: queue.count), ('stat',))
+        REGISTRY.gauge('chat_outbound_queue_bytes', 'Байты в исходящих очередях: всего и в самой длинной',
+                       lambda: self.queue_depths(lambda queue: queue.size), ('stat',))
+        REGISTRY.gauge('chat_outbound_dropped_frames', 'Кадры, выброшенные из очередей текущих соединений',
+                       lambda: self.queue_depths(lambda queue: queue.dropped), ('stat',))
+        REGISTRY.gauge('chat_db_pending_writes', 'Записи в очереди фонового писателя базы', self.db.pending)
+
+    def queue_depths(self, measure):
+        """Сумма и максимум величины по исходящим очередям подключённых клиентов."""
+        values = [measure(conn.queue) for _, (_, conn) in self.state.iter_connections()]
+        return {('total',): sum(values), ('max',): max(values, default=0)}
 
     def setup_routes(self):
-        """Настройка маршрутов Flask API."""
+        """Настройка маршрутов HTTP API.
 
-        @self.app.route('/update_groups', methods=['GET'])
-        def update_groups():
+        Списки пользователей и групп кэшируются по версиям состояния, поэтому повторный опрос
+        без изменений отдаётся из кэша или ответом 304.
+        """
+
+        @self.api.route('/update_groups',
+                        version=lambda request: self.state.group_version(request.args.get('nickname')))
+        def update_groups(request):
             """Обработка запроса на получение групп пользователя."""
             nickname = request.args.get('nickname')
             if not nickname:
-                return jsonify({"error": "Nickname is required"}), 400
+                return json_response({"error": "Nickname is required"}, 400)
             groups = self.get_user_groups(nickname)
-            return jsonify({"update_groups": groups})
+            return json_response({"update_groups": groups, "version": self.state.group_version(nickname)})
 
-        @self.app.route('/update_users', methods=['GET'])
-        def update_users():
+        @self.api.route('/update_users', version=lambda request: self.state.roster_version)
+        def update_users(request):
             """Обработка запроса на получение списка пользователей."""
             nickname = request.args.get('nickname')
             users = self.get_users_list(nickname=nickname)
-            return jsonify({"update_users": users})
+            return json_response({"update_users": users, "version": self.state.roster_version})
 
-        @self.app.route('/last_nicknames', methods=['GET'])
-        def last_nicknames():
-            """Обработка запроса на получение последних никнеймов по IP-адресу."""
-            user_ip = request.args.get('ip_address')
+        @self.api.route('/last_nicknames', blocking=True)
+        def last_nicknames(request):
+            """Последние никнеймы по IP-адресу; без ip_address - по адресу, с которого пришёл запрос."""
+            user_ip = request.args.get('ip_address') or (request.peer[0] if request.peer else None)
             if not user_ip:
-                return jsonify({"error": "IP address is required"}), 400
+                return json_response({"error": "IP address is required"}, 400)
             nicknames = self.get_latest_nicknames_from_db(user_ip)
-            return jsonify({"last_nicknames": nicknames})
+            return json_response({"last_nicknames": nicknames})
+
+        @self.api.route('/history', blocking=True)
+        def history(request):
+            """Страница истории канала: сообщения с id меньше before, не больше limit.
+
+            Общий канал открыт всем; группы и личные переписки - только по токену сессии, ник
+            берётся из сессии, а не из запроса.
+            """
+            name = request.args.get('channel', GLOBAL)
+            nickname = self.session_owner(request.args.get('session'))
+            channel = self.resolve_channel(nickname, name) if nickname or name == GLOBAL else None
+            if channel is None:
+                return json_response({"error": "Channel is not available"}, 403)
+            before = request.arg_int('before')
+            limit = request.arg_int('limit', PAGE_SIZE)
+            return json_response(self.history_page(name, channel, before, limit))
+
+        @self.api.route('/search')
+        def search(request):
+            """Автодополнение: ники онлайн и группы пользователя, начинающиеся с prefix."""
+            return json_response(self.search_names(request.args.get('nickname'), request.args.get('prefix', ''),
+                                                   request.arg_int('limit', SEARCH_LIMIT)))
+
+        @self.api.route('/metrics')
+        def metrics(request):
+            """Метрики сервера в текстовом формате Prometheus."""
+            return text_response(REGISTRY.render(), CONTENT_TYPE)
+
+    def session_owner(self, token):
+        """Ник по токену сессии. Сессии других узлов (в том числе рабочих процессов) знает брокер."""
+        nickname = self.sessions.owner(token)
+        if nickname is None and token and self.bus.clustered:
+            reply = self.bus.request({"type": "session", "session": token})
+            nickname = reply.get('nickname') if reply and reply.get('ok') else None
+        return nickname
 
     def get_user_groups(self, nickname):
         """Получение списка групп пользователя."""
-        user_groups = []
-        for group, members in self.groups.items():
-            if nickname in members['members']:
-                user_groups.append(group)
-        return user_groups
+        return self.state.user_groups(nickname)
 
     def get_users_list(self, nickname):
         """Получение списка пользователей."""
-        return list(key for key in self.connections.keys() if key != nickname)
+        return self.state.users_except(nickname)
 
     def save_nickname_to_db(self, nickname, ip_address):
-        """Сохранение никнейма и IP-адреса в базу данных."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''INSERT OR REPLACE INTO nicknames (nickname, ip_address)
-                              VALUES (?, ?)''', (nickname, ip_address))
-        conn.commit()
-        conn.close()
+        """Сохранение никнейма и IP-адреса в базу данных (пакетной записью в фоне)."""
+        self.db.save_nickname(nickname, ip_address)
 
     def get_latest_nicknames_from_db(self, user_ip):
-        """Получение всех никнеймов и IP-адресов из базы данных."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT nickname FROM nicknames WHERE ip_address = ?", (user_ip,))
-        rows = cursor.fetchall()
-        rows = ', '.join([row[0] for row in rows])
-        conn.close()
-        return rows
+        """Получение всех никнеймов, использованных с IP-адреса."""
+        return ', '.join(self.db.latest_nicknames(user_ip))
 
     @staticmethod
     def get_ip():
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(('8.8.8.8', 80))
-        ip = s.getsockname()[0]
-        s.close()
-        return ip
-
-    def update_clients_group_list(self):
-        """Отправка обновленных списков групп только тем клиентам, кто в них состоит."""
-        for nickname, (_, conn) in self.connections.items():
-            user_groups = []
-            for group, members in self.groups.items():
-                if nickname in members['members']:
-                    user_groups.append(group)
-            self.send_message(conn, f"update_groups {','.join(user_groups)}")
-
-    def update_clients_user_list(self):
-        """Отправка обновленного списка пользователей, исключая самого себя."""
-        for nickname, (_, conn) in self.connections.items():
-            user_list = [user for user in self.connections.keys() if user != nickname]
-            self.send_message(conn, f"update_users {','.join(user_list)}")
-
-    def send_message(self, conn, message):
-        """Универсальная отправка сообщения клиенту с обработкой ошибок."""
-        try:
-            conn.send(message.encode())
-        except Exception as e:
-            print(f"Ошибка отправки сообщения: {e}")
-
-    def send_message_to_all(self, message, sender_nickname=None):
-        """Отправка сообщения всем пользователям, кроме отправителя."""
-        if len(self.recent_messages) >= 15:
-            self.recent_messages.pop(0)
-        self.recent_messages.append(message)
-
-        for nickname, (_, conn) in self.connections.items():
+        return local_ip()
+
+    def publish_roster(self, added=(), removed=(), exclude=None):
+        """Рассылка изменения списка пользователей всем клиентам одним кадром на кодек."""
+        payload = {"version": self.state.roster_version, "added": list(added), "removed": list(removed)}
+        frames = Frames(lambda codec: codec.control('roster_delta', payload))
+        for nickname, (_, conn) in self.state.iter_connections():
+            if nickname != exclude:
+                self.send_frame(conn, frames[conn.codec])
+
+    def publish_user_groups(self, nickname, added=(), removed=()):
+        """Отправка пользователю изменения его списка групп."""
+        conn = self.state.get_connection(nickname)
+        if conn is not None:
+            self.send_control(conn, 'groups_delta', {
+                "version": self.state.group_version(nickname), "added": list(added), "removed": list(removed)})
+
+    def roster_snapshot_frame(self, codec):
+        """Кадр с полным списком пользователей; строится один раз на версию списка и кодек."""
+        return self.state.roster_cached(('roster_snapshot', codec), lambda: codec.control(
+            'roster_snapshot', {"version": self.state.roster_version, "users": self.state.users()}))
+
+    def send_join_sequence(self, conn, nickname, session, resumed=False):
+        """Вход клиента: приветствие с токеном сессии, история, список пользователей и его группы.
+
+        Кадры уходят одной пачкой в очередь соединения, поэтому клиент получает их раздельно
+        и строго по порядку без пауз; версии снимков согласованы с последующими изменениями.
+        resumed - та же последовательность для сессии, перенесённой с другого узла (см. take_over).
+        """
+        codec = conn.codec
+        welcome = {"nickname": nickname, "sequence": JOIN_SEQUENCE, "session": session}
+        if resumed:
+            welcome["resumed"] = True
+        welcome = codec.control('welcome', welcome)
+        history = codec.control('history', self.history_page(GLOBAL, GLOBAL, None, 15))
+        groups = codec.control('groups_snapshot', {
+            "version": self.state.group_version(nickname), "groups": self.get_user_groups(nickname)})
+        self.send_frame(conn, b''.join((welcome, history, self.roster_snapshot_frame(codec), groups)))
+
+    def new_queue(self):
+        """Исходящая очередь для нового соединения."""
+        return OutboundQueue(self.outbound_policy)
+
+    def send_frame(self, conn, frame, key=None):
+        """Постановка готового кадра в очередь клиента; медленный клиент отключается по политике."""
+        if not conn.push(frame, key):
+            SEND_ERRORS.inc('slow_consumer')
+            print(f"Клиент {conn} не успевает читать, соединение закрыто.")
+            conn.abort()
+
+    def send_message(self, conn, message, key=None):
+        """Универсальная отправка сообщения клиенту."""
+        self.send_frame(conn, conn.codec.text(message), key)
+
+    def send_control(self, conn, kind, payload):
+        """Отправка служебного сообщения в кодировке клиента."""
+        self.send_frame(conn, conn.codec.control(kind, payload))
+
+    def send_message_to_all(self, message, sender_nickname=None, kind='system'):
+        """Отправка сообщения в общий чат всем пользователям, кроме отправителя, с записью в историю."""
+        record = self.history.append(GLOBAL, kind, sender_nickname, message)
+        self.deliver_global(record, sender_nickname)
+        self.bus.publish({"type": "global", "sender": sender_nickname, "kind": kind, "body": message})
+
+    def deliver_global(self, record, sender_nickname):
+        """Рассылка сообщения общего чата клиентам этого узла одним кадром на кодек."""
+        started = time.perf_counter()
+        frames = Frames(lambda codec: codec.record(record))
+        recipients = 0
+        for nickname, (_, conn) in self.state.iter_connections():
             if nickname != sender_nickname:
-                self.send_message(conn, message)
+                self.send_frame(conn, frames[conn.codec])
+                recipients += 1
+        BROADCAST_FANOUT.observe(recipients)
+        BROADCAST_SECONDS.observe(time.perf_counter() - started)
+
+    def deliver(self, nickname, message):
+        """Отправка текста пользователю, к какому бы узлу кластера он ни был подключён."""
+        conn = self.state.get_connection(nickname)
+        if conn is not None:
+            self.send_message(conn, message)
+        elif self.state.node_of(nickname) is not None:
+            self.bus.publish({"type": "deliver", "to": nickname, "text": message})
 
     def send_private_message(self, recipient_nickname, msg, sender_nickname):
-        """Отправка личного сообщения пользователю."""
-        if recipient_nickname in self.connections:
-            conn = self.connections[recipient_nickname][1]
-            private_msg = f"[ЛС от {sender_nickname}]: {msg}"
-            self.send_message(conn, private_msg)
-        else:
-            error_msg = f"Пользователь {recipient_nickname} не найден."
-            self.send_message(self.connections[sender_nickname][1], error_msg)
-
-    def handle_group_command(self, nickname, msg, conn):
-        """Обработка команд группового чата."""
-        parts = msg.split(" ", 2)
-        command = parts[0]
-
-        if command == "/help":
-            self.send_message(conn, "Доступные команды:\n/help - Список доступных команд."
-                                    "\n/create_group <group_name> - Создать новую группу."
-                                    "\n/invite <group_name> <user_name> - Пригласить пользователя в группу."
-                                    "\n/leave_group <group_name> - Покинуть группу."
-                                    "\n/group_msg <group_name> <message> - Отправить сообщение в группу."
-                                    "\n/p <user_name> <message> - Отправить личное сообщение.")
+        """Отправка личного сообщения пользователю.
 
-        elif command == "/create_group":
-            self.create_group(parts, conn, nickname)
-
-        elif command == "/invite":
-            self.invite_to_group(parts, conn, nickname)
-
-        elif command == "/leave_group":
-            self.leave_group(parts, conn, nickname)
-
-        elif command == "/group_msg":
-            self.group_message(parts, conn, nickname)
-
-        elif command == "/users":
-            user_list = "\n".join(self.connections.keys())
-            self.send_message(conn, f"Подключённые пользователи:\n{user_list}")
+        Событие уходит всем узлам кластера, а не только узлу получателя: переписка попадает в журнал
+        каждого узла, и её историю отдаёт любой из них (в том числе HTTP API первого рабочего процесса).
+        """
+        if not self.state.is_online(recipient_nickname):
+            error_msg = f"Пользователь {recipient_nickname} не найден."
+            self.send_message(self.state.get_connection(sender_nickname), error_msg)
+            return
+        record = self.history.append(dm_channel(sender_nickname, recipient_nickname), 'chat', sender_nickname, msg)
+        conn = self.state.get_connection(recipient_nickname)
+        if conn is not None:
+            self.send_frame(conn, conn.codec.record(record))
+        self.bus.publish({"type": "private", "recipient": recipient_nickname, "sender": sender_nickname, "body": msg})
+
+    def setup_commands(self):
+        """Таблица команд клиента: обработчик вызывается как handler(parts, conn, nickname)."""
+        register = self.commands.register
+        register('/help', self.help_command, usage="/help - Список доступных команд.")
+        register('/create_group', self.create_group, maxsplit=2,
+                 usage="/create_group <group_name> - Создать новую группу.")
+        register('/invite', self.invite_to_group, maxsplit=2,
+                 usage="/invite <group_name> <user_name> - Пригласить пользователя в группу.")
+        register('/leave_group', self.leave_group, maxsplit=2, usage="/leave_group <group_name> - Покинуть группу.")
+        register('/group_msg', self.group_message, maxsplit=2,
+                 usage="/group_msg <group_name> <message> - Отправить сообщение в группу.")
+        register('/p', self.private_command, maxsplit=2, kind='private',
+                 usage="/p <user_name> <message> - Отправить личное сообщение.")
+        register('/history', self.history_command,
+                 usage="/history <global|group:name|dm:user> [before_id] [limit] - История канала.")
+        register('/search', self.search_command,
+                 usage="/search <prefix> [limit] - Поиск пользователей и своих групп по началу имени.")
+        register('/users', self.users_command)
+
+    def help_command(self, parts, conn, nickname):
+        self.send_message(conn, self.commands.help())
+
+    def users_command(self, parts, conn, nickname):
+        user_list = "\n".join(self.state.users())
+        self.send_message(conn, f"Подключённые пользователи:\n{user_list}")
+
+    def private_command(self, parts, conn, nickname):
+        """Личное сообщение: /p <ник> <сообщение>."""
+        if len(parts) < 3:
+            self.send_message(conn, 'Формат: /p ник_пользователя сообщение')
+        else:
+            self.send_private_message(parts[1], parts[2], nickname)
 
     def create_group(self, parts, conn, nickname):
         """Создание новой группы."""
@@ -184,12 +340,23 @@ class ChatServer:
             return
 
         group_name = parts[1]
-        if group_name in self.groups:
+        if not valid_name(group_name):
+            self.send_message(conn, f"Ошибка: название группы длиннее {MAX_NAME_BYTES} байт.")
+            return
+        if self.state.get_group(group_name) is not None:
+            self.send_message(conn, "Группа уже существует.")
+            return
+        self.bus_call(conn, {"type": "group_create", "group": group_name, "owner": nickname},
+                      lambda reply: self.group_created(conn, nickname, group_name, reply),
+                      late=lambda reply: self.group_created(conn, nickname, group_name, reply))
+
+    def group_created(self, conn, nickname, group_name, reply):
+        """Создание группы после того, как брокер закрепил имя."""
+        if not reply or not reply.get('ok') or self.state.create_group(group_name, nickname) is None:
             self.send_message(conn, "Группа уже существует.")
         else:
-            self.groups[group_name] = {"owner": nickname, "members": [nickname]}
             self.send_message(conn, f"Группа {group_name} создана.")
-            self.update_clients_group_list()
+            self.publish_user_groups(nickname, added=[group_name])
 
     def invite_to_group(self, parts, conn, nickname):
         """Приглашение пользователя в группу."""
@@ -198,25 +365,26 @@ class ChatServer:
             return
 
         group_name, new_member = parts[1], parts[2]
-        if group_name not in self.groups:
+        group = self.state.get_group(group_name)
+        if group is None:
             self.send_message(conn, "Группа не найдена.")
             return
 
-        if self.groups[group_name]["owner"] != nickname:
+        if group.owner != nickname:
             self.send_message(conn, "Вы не являетесь владельцем этой группы.")
             return
 
-        if new_member not in self.connections:
+        if not self.state.is_online(new_member):
             self.send_message(conn, f"Пользователь {new_member} не найден.")
             return
 
-        if new_member in self.groups[group_name]["members"]:
+        if not self.state.add_member(group_name, new_member):
             self.send_message(conn, f"{new_member} уже в группе.")
             return
 
-        self.groups[group_name]["members"].append(new_member)
-        self.update_clients_group_list()
-        self.send_message(self.connections[new_member][1], f"Вы были приглашены в группу {group_name}.")
+        self.bus.publish({"type": "group_add", "group": group_name, "member": new_member})
+        self.publish_user_groups(new_member, added=[group_name])
+        self.deliver(new_member, f"Вы были приглашены в группу {group_name}.")
         self.send_message_to_all(f"{new_member} присоединился к группе {group_name}!", sender_nickname=new_member)
 
     def leave_group(self, parts, conn, nickname):
@@ -226,15 +394,16 @@ class ChatServer:
             return
 
         group_name = parts[1]
-        if group_name not in self.groups:
+        if self.state.get_group(group_name) is None:
             self.send_message(conn, "Группа не найдена.")
             return
 
-        if nickname not in self.groups[group_name]["members"]:
+        if not self.state.remove_member(group_name, nickname):
             self.send_message(conn, "Вы не состоите в этой группе.")
             return
 
-        self.groups[group_name]["members"].remove(nickname)
+        self.bus.publish({"type": "group_remove", "group": group_name, "member": nickname})
+        self.publish_user_groups(nickname, removed=[group_name])
         self.send_message_to_all(f"{nickname} покинул группу {group_name}.", sender_nickname=nickname)
         self.send_message(conn, f"Вы покинули группу {group_name}.")
 
@@ -245,89 +414,572 @@ class ChatServer:
             return
 
         group_name, group_msg = parts[1], parts[2]
-        if group_name in self.groups and nickname in self.groups[group_name]["members"]:
-            for member in self.groups[group_name]["members"]:
-                if member != nickname:
-                    self.send_message(self.connections[member][1], f"[Группа {group_name} | {nickname}]: {group_msg}")
+        if self.state.is_member(group_name, nickname):
+            if not self.allow_channel(conn, group_channel(group_name)):
+                return
+            record = self.history.append(group_channel(group_name), 'chat', nickname, group_msg)
+            self.deliver_group(record, group_name, nickname)
+            self.bus.publish({"type": "group_msg", "group": group_name, "sender": nickname, "body": group_msg})
         else:
             self.send_message(conn, "Вы не состоите в этой группе.")
 
-    def handle_connection(self, conn, addr):
-        """Обработка подключения клиента."""
-        nickname = None
+    def deliver_group(self, record, group_name, sender_nickname):
+        """Рассылка сообщения группы её участникам, подключённым к этому узлу.
+
+        Список соединений группы берётся готовым из кэша состояния, кадр кодируется один раз на
+        кодек; ушедшие участники получат сообщение из входящих при следующем входе.
+        """
+        frames = Frames(lambda codec: codec.record(record))
+        send = self.send_frame
+        live = self.state.group_connections(group_name)
+        for member, member_conn in live:
+            if member != sender_nickname:
+                send(member_conn, frames[member_conn.codec])
+        GROUP_FANOUT.observe(len(live))
+
+    def resolve_channel(self, nickname, name):
+        """Канал истории по имени из запроса клиента; None, если он недоступен пользователю."""
+        if name == GLOBAL:
+            return GLOBAL
+        kind, _, target = name.partition(':')
+        if kind == 'group' and self.state.is_member(target, nickname):
+            return group_channel(target)
+        if kind == 'dm' and target:
+            return dm_channel(nickname, target)
+        return None
+
+    def history_page(self, name, channel, before, limit):
+        """Страница истории в виде, общем для сокета и HTTP API; before None - последняя страница канала."""
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        records = self.history.page(channel, before, limit)
+        messages = to_dicts(records, newest=True)
+        return {"channel": name, "before": before, "messages": messages,
+                "more": len(records) == limit or len(messages) < len(records)}
+
+    def history_command(self, parts, conn, nickname):
+        """Запрос страницы истории: /history <канал> [до_id] [лимит]."""
+        if len(parts) < 2:
+            self.send_message(conn, "Ошибка: укажите канал. Пример: /history global 120 50")
+            return
+        channel = self.resolve_channel(nickname, parts[1])
+        if channel is None:
+            self.send_message(conn, "Канал недоступен.")
+            return
         try:
-            latest_nickname = self.get_latest_nicknames_from_db(addr[0])
-            if latest_nickname:
-                self.send_message(conn, f"/last_nicknames: {self.get_latest_nicknames_from_db(addr[0])}")
-            else:
-                self.send_message(conn, f"/last_nicknames: ")
-
-            nickname = conn.recv(1024).decode()
+            before = int(parts[2]) if len(parts) > 2 else None
+            limit = int(parts[3]) if len(parts) > 3 else PAGE_SIZE
+        except ValueError:
+            self.send_message(conn, "Ошибка: до_id и лимит должны быть числами.")
+            return
+        self.offload(conn, lambda: conn.codec.control('history', self.history_page(parts[1], channel, before, limit)))
 
-            if not nickname or nickname in self.connections:
+    def search_command(self, parts, conn, nickname):
+        """Поиск для автодополнения: /search <префикс> [лимит]."""
+        try:
+            limit = int(parts[2]) if len(parts) > 2 else SEARCH_LIMIT
+        except ValueError:
+            self.send_message(conn, "Ошибка: лимит должен быть числом.")
+            return
+        self.send_control(conn, 'search', self.search_names(nickname, parts[1] if len(parts) > 1 else '', limit))
+
+    def search_names(self, nickname, prefix, limit):
+        """Ники онлайн (кроме самого пользователя) и его группы по префиксу, не больше limit каждого."""
+        limit = max(1, min(limit, MAX_SEARCH_LIMIT))
+        users = [user for user in self.state.search_users(prefix, limit + 1) if user != nickname][:limit]
+        groups = self.state.search_groups(prefix, limit, nickname) if nickname else []
+        return {"prefix": prefix, "users": users, "groups": groups}
+
+    def greet(self, conn, addr):
+        """Отправка клиенту последних никнеймов, использованных с его адреса."""
+        latest_nickname = self.get_latest_nicknames_from_db(addr[0])
+        self.send_message(conn, f"/last_nicknames: {latest_nickname or ''}")
+
+    def negotiate(self, conn, message):
+        """Согласование кодирования по сообщению hello до никнейма. True, если это было hello."""
+        codec = parse_hello(message)
+        if codec is None:
+            return False
+        conn.codec = codec
+        return True
+
+    def login(self, conn, addr, nickname):
+        """Регистрация клиента под выбранным никнеймом (уникальным во всём кластере).
+
+        Возвращает ник, False при отказе или None, пока ждём ответа брокера (см. bus_call).
+        """
+        if not valid_nickname(nickname):
+            self.send_message(conn, 'Никнейм занят или некорректен.')
+            return False
+        token = new_token()
+        return self.bus_call(conn, {"type": "join", "nickname": nickname, "ip": addr[0], "session": token},
+                             lambda reply: self.join(conn, addr, nickname, token, reply),
+                             late=lambda reply: self.abandon(nickname))
+
+    def join(self, conn, addr, nickname, token, reply):
+        """Вход после того, как брокер закрепил ник за этим узлом. Возвращает ник или False."""
+        if not reply or not reply.get('ok'):
+            self.send_message(conn, 'Никнейм занят или некорректен.')
+            return False
+        with self.state.roster_lock:
+            if not self.state.add_user(nickname, addr, conn):
+                self.bus.publish({"type": "leave", "nickname": nickname})
                 self.send_message(conn, 'Никнейм занят или некорректен.')
-                conn.close()
+                return False
+            self.send_join_sequence(conn, nickname, self.sessions.open(nickname, token).token)
+            self.publish_roster(added=[nickname], exclude=nickname)
+            # Всё, что записано после этого id, пользователь получит обычной рассылкой.
+            joined_at = self.history.last_id
+        self.offload(conn, self.inbox_frame, conn.codec, nickname, joined_at)
+
+        self.save_nickname_to_db(nickname, addr[0])
+        welcome_msg = f'--- {nickname} присоединился к чату! ---'
+        self.send_message_to_all(message=welcome_msg, sender_nickname=nickname)
+        return self.entered(conn, nickname)
+
+    def inbox_frame(self, codec, nickname, joined_at):
+        """Сообщения групп, пришедшие, пока пользователя не было в чате; b'', если их нет (нужна база)."""
+        left_at = self.db.inbox_cursor(nickname)
+        if left_at is None:
+            return b''
+        channels = [group_channel(group_name) for group_name in self.get_user_groups(nickname)]
+        records = self.history.between(channels, left_at, joined_at, INBOX_LIMIT + 1)
+        if not records:
+            return b''
+        messages = to_dicts(records[:INBOX_LIMIT])
+        return codec.control('missed', {"messages": messages, "more": len(messages) < len(records), "inbox": True})
+
+    def handshake(self, conn, addr, msg):
+        """Сообщение клиента до входа: hello, resume или никнейм.
+
+        Возвращает ник, если клиент вошёл, None - ждать следующего сообщения, False - закрыть соединение.
+        В режиме asyncio в кластере ответ может прийти позже - результатом conn.waiting.
+        """
+        if self.negotiate(conn, msg):
+            return None
+        request = parse_resume(msg)
+        if request is not None:
+            return self.resume(conn, addr, request)
+        return self.login(conn, addr, msg)
+
+    def entered(self, conn, nickname):
+        """Клиент вошёл или вернулся в сессию: своя корзина ограничения частоты."""
+        conn.bucket = self.limiter.client_bucket()
+        return nickname
+
+    def resume(self, conn, addr, request):
+        """Возвращение в сессию по токену: клиент получает только пропущенное, остальные ничего не замечают.
+
+        Если сессии нет, клиенту уходит resume {"ok": false} и он входит заново по никнейму.
+        """
+        claimed = self.sessions.claim(request.get('session'))
+        if claimed is not None:
+            session, detached = claimed
+            if self.state.replace_connection(session.nickname, detached, addr, conn):
+                self.bus.publish({"type": "attach", "session": session.token})
+                self.send_resume_sequence(conn, session, request)
+                return self.entered(conn, session.nickname)
+            self.sessions.close(session)
+        elif self.bus.clustered and request.get('session'):
+            # Сессия могла остаться на другом узле кластера: брокер переносит её сюда.
+            return self.bus_call(conn, {"type": "resume", "session": request['session']},
+                                 lambda reply: self.take_over(conn, addr, request, reply),
+                                 late=lambda reply: self.abandon(reply['nickname']))
+        self.send_control(conn, 'resume', {"ok": False})
+        return None
+
+    def take_over(self, conn, addr, request, reply):
+        """Возвращение в сессию, открытую на другом узле, после того как брокер перенёс ник сюда.
+
+        Каждый узел нумерует сообщения сам, поэтому last_id клиента здесь ничего не значит: вместо
+        пропущенного клиент получает полную пересинхронизацию, как при входе. Возвращает ник или None.
+        """
+        if not reply or not reply.get('ok'):
+            self.send_control(conn, 'resume', {"ok": False})
+            return None
+        nickname = reply['nickname']
+        session = self.sessions.open(nickname, request['session'])
+        with self.state.roster_lock:
+            if self.state.take_over(nickname, addr, conn):
+                self.publish_roster(added=[nickname], exclude=nickname)
+            self.send_join_sequence(conn, nickname, session.token, resumed=True)
+        print(f'Сессия {nickname} перенесена с другого узла: {conn}')
+        return self.entered(conn, nickname)
+
+    def send_resume_sequence(self, conn, session, request):
+        """Приветствие, пропущенные сообщения и снимки списков, только если их версии изменились.
+
+        Снимки строятся сразу, пропущенное (до текущего id; более новое придёт обычной рассылкой)
+        читается из базы вне цикла событий.
+        """
+        nickname = session.nickname
+        codec = conn.codec
+        last_id = request.get('last_id') or 0
+        until = self.history.last_id
+        sequence = ['missed']
+        frames = []
+        if request.get('roster_version') != self.state.roster_version:
+            sequence.append('roster_snapshot')
+            frames.append(self.roster_snapshot_frame(codec))
+        if request.get('groups_version') != self.state.group_version(nickname):
+            sequence.append('groups_snapshot')
+            frames.append(codec.control('groups_snapshot', {
+                "version": self.state.group_version(nickname), "groups": self.get_user_groups(nickname)}))
+        welcome = codec.control('welcome', {"nickname": nickname, "sequence": sequence,
+                                            "session": session.token, "resumed": True})
+
+        channels = [GLOBAL] + [group_channel(group_name) for group_name in self.get_user_groups(nickname)]
+
+        def build():
+            records = self.history.missed(nickname, channels, last_id, until, RESUME_LIMIT + 1)
+            print(f'Сессия {nickname} возобновлена: {conn}, пропущено сообщений: {len(records)}')
+            messages = to_dicts(records[:RESUME_LIMIT])
+            missed = codec.control('missed', {"messages": messages, "more": len(messages) < len(records)})
+            return b''.join([welcome, missed] + frames)
+
+        self.offload(conn, build)
+
+    def disconnect(self, nickname, conn, clean):
+        """Конец соединения. Без CLOSE ник остаётся за сессией на время ожидания, иначе - выход из чата."""
+        session = self.sessions.get(nickname)
+        if not clean and session is not None:
+            detached = DetachedConnection(conn.addr, conn.codec)
+            if self.state.replace_connection(nickname, conn, conn.addr, detached):
+                self.sessions.detach(session, detached, lambda expired: self.dispatch(self.expire_session, expired))
+                self.bus.publish({"type": "detach", "nickname": nickname, "session": session.token})
+                # Пока ждём клиента, сообщения ему отбрасываются: если он не вернётся, они попадут во входящие.
+                self.db.save_inbox_cursor(nickname, self.history.last_id)
+                print(f'Связь с {nickname} потеряна, сессия ждёт возвращения: {conn}')
+                return
+        if session is not None:
+            self.sessions.close(session)
+        self.logout(nickname, conn)
+
+    def expire_session(self, session):
+        """Клиент не вернулся за время ожидания - выход из чата."""
+        detached = self.sessions.expire(session)
+        if detached is not None:
+            # Курсор входящих сохранён при обрыве связи.
+            self.logout(session.nickname, detached, save_cursor=False)
+
+    def logout(self, nickname, conn, save_cursor=True):
+        """Удаление клиента из чата и оповещение остальных."""
+        with self.state.roster_lock:
+            if not self.state.remove_user(nickname, conn):
                 return
+            self.publish_roster(removed=[nickname])
+        if save_cursor:
+            # Сообщения групп после этого id попадут во входящие при следующем входе.
+            self.db.save_inbox_cursor(nickname, self.history.last_id)
+        self.bus.publish({"type": "leave", "nickname": nickname})
+        print(f'Соединение приостановлено: {conn}, {conn.addr}')
+        self.send_message_to_all(message=f'--- {nickname} покинул чат ---', sender_nickname=nickname)
+
+    def handle_message(self, nickname, msg, conn):
+        """Обработка одного сообщения клиента. Возвращает False, если клиент уходит."""
+        if msg == 'CLOSE':
+            return False
+        if len(msg) * 4 > MAX_MESSAGE_SIZE and len(msg.encode()) > MAX_MESSAGE_SIZE:
+            self.send_message(conn, f"Ошибка: сообщение длиннее {MAX_MESSAGE_SIZE} байт не принято.")
+            return True
+
+        wait = self.limiter.check_client(conn.bucket)
+        if wait:
+            self.reject(conn, wait, 'client')
+
+        elif msg[:1] == "/":
+            MESSAGES.inc(self.commands.dispatch(msg, conn, nickname))
+        elif self.allow_channel(conn, GLOBAL):
+            MESSAGES.inc('global')
+            self.send_message_to_all(message=msg, sender_nickname=nickname, kind='chat')
+        return True
+
+    def allow_channel(self, conn, channel):
+        """Проверка лимита канала; отправитель превысившего лимит сообщения получает ошибку."""
+        wait = self.limiter.check_channel(channel)
+        if wait:
+            self.reject(conn, wait, 'channel', channel)
+        return not wait
+
+    def reject(self, conn, wait, scope, channel=None):
+        """Ошибка протокола rate_limited: сообщение не принято, повторить не раньше чем через retry_after секунд."""
+        self.send_frame(conn, conn.codec.control('error', {
+            "code": "rate_limited", "scope": scope, "channel": channel, "retry_after": round(wait, 3)}),
+            key='rate_limited')
+
+    def bus_call(self, conn, event, then, late=None):
+        """Запрос к шине кластера от имени клиента; then(ответ или None) решает, что делать дальше.
+
+        Одиночный узел и режим threads ждут ответа сразу и возвращают результат then. В режиме
+        asyncio ответ не ждётся в цикле событий: возвращается None, а conn.waiting - Future
+        с результатом then; следующие сообщения клиента обрабатываются только после него.
+        Если брокер ответил согласием уже после таймаута (then получил None), вызывается late(ответ):
+        применённое брокером нужно отменить или довести до конца.
+        """
+        if self.loop is None or not self.bus.clustered:
+            return then(self.bus.request(event, late))
+        waiting = conn.waiting = self.loop.create_future()
+
+        def resolve(reply):
+            if waiting.done():
+                if late is not None and reply and reply.get('ok'):
+                    late(reply)
+                return
+            try:
+                waiting.set_result(then(reply))
+            except Exception as e:
+                waiting.set_exception(e)
+
+        self.loop.call_later(self.bus.timeout, resolve, None)
+        self.bus.request_async(event, lambda reply: self.loop.call_soon_threadsafe(resolve, reply))
+        return None
+
+    def abandon(self, nickname):
+        """Брокер закрепил ник за этим узлом, когда клиенту уже отказали: ник освобождается в кластере."""
+        print(f'Ответ брокера для {nickname} пришёл после таймаута, ник освобождён.')
+        self.bus.publish({"type": "leave", "nickname": nickname})
+
+    def offload(self, conn, work, *args):
+        """Чтение базы вне цикла событий: кадр work(*args) уходит клиенту раньше всего поставленного после вызова.
+
+        В режиме asyncio работа выполняется в общем пуле потоков цикла, а вывод соединения придержан
+        до её окончания; в режиме threads - сразу в потоке клиента. Пустой кадр не отправляется.
+        """
+        if self.loop is None:
+            frame = work(*args)
+            if frame:
+                self.send_frame(conn, frame)
+            return
+        conn.hold()
+        self.loop.run_in_executor(None, work, *args).add_done_callback(lambda done: self.release(conn, done))
 
-            self.save_nickname_to_db(nickname, addr[0])
-            self.connections[nickname] = (addr, conn)
-            welcome_msg = f'--- {nickname} присоединился к чату! ---'
-            self.send_message(conn, "\n".join(self.recent_messages))
-            self.send_message_to_all(message=welcome_msg, sender_nickname=nickname)
-            time.sleep(0.5)
-            self.update_clients_user_list()
-
-            while True:
-                msg = conn.recv(1024).decode()
-                if msg == 'CLOSE':
-                    leave_msg = f'--- {nickname} покинул чат ---'
-                    print(f'Соединение приостановлено: {conn}, {addr}')
-                    if nickname in self.connections:
-                        del self.connections[nickname]
-                    self.update_clients_user_list()
-                    self.send_message_to_all(message=leave_msg, sender_nickname=nickname)
+    @staticmethod
+    def release(conn, done):
+        try:
+            frame = done.result()
+        except Exception as e:
+            print(f'Ошибка чтения истории для {conn}: {e}')
+            frame = b''
+        conn.release(frame)
+
+    def dispatch(self, handler, *args):
+        """Вызов из постороннего потока; в режиме asyncio - переносится в цикл событий."""
+        if self.call_soon is not None:
+            self.call_soon(handler, *args)
+        else:
+            handler(*args)
+
+    def handle_bus_event(self, event):
+        """Событие от других узлов кластера (вызывается потоком шины)."""
+        handler = self.bus_handlers.get(event['type'])
+        if handler is not None:
+            self.dispatch(handler, event)
+
+    def on_sync(self, event):
+        """Справочник кластера при подключении узла: пользователи других узлов и все группы."""
+        for nickname, node in event['users'].items():
+            self.state.add_remote_user(nickname, node)
+        for group_name, group in event['groups'].items():
+            self.state.create_group(group_name, group['owner'])
+            for member in group['members']:
+                self.state.add_member(group_name, member)
+
+    def on_join(self, event):
+        nickname = event['nickname']
+        with self.state.roster_lock:
+            if self.state.add_remote_user(nickname, event['node']):
+                self.publish_roster(added=[nickname])
+        self.save_nickname_to_db(nickname, event['ip'])
+
+    def on_resume(self, event):
+        """Пользователь вернулся в сессию через другой узел; если сессия была здесь - она закрывается."""
+        nickname = event['nickname']
+        session = self.sessions.get(nickname)
+        conn = self.state.get_connection(nickname)
+        if session is not None:
+            self.sessions.close(session)
+        with self.state.roster_lock:
+            if self.state.hand_over(nickname, event['node']):
+                self.publish_roster(added=[nickname])
+        if conn is not None:
+            conn.abort()
+
+    def on_leave(self, event):
+        with self.state.roster_lock:
+            if self.state.remove_remote_user(event['nickname']):
+                self.publish_roster(removed=[event['nickname']])
+
+    def on_global(self, event):
+        record = self.history.append(GLOBAL, event['kind'], event['sender'], event['body'])
+        self.deliver_global(record, event['sender'])
+
+    def on_private(self, event):
+        record = self.history.append(dm_channel(event['sender'], event['recipient']), 'chat', event['sender'],
+                                     event['body'])
+        conn = self.state.get_connection(event['recipient'])
+        if conn is not None:
+            self.send_frame(conn, conn.codec.record(record))
+
+    def on_deliver(self, event):
+        conn = self.state.get_connection(event['to'])
+        if conn is not None:
+            self.send_message(conn, event['text'])
+
+    def on_group_create(self, event):
+        self.state.create_group(event['group'], event['owner'])
+
+    def on_group_add(self, event):
+        if self.state.add_member(event['group'], event['member']):
+            self.publish_user_groups(event['member'], added=[event['group']])
+
+    def on_group_remove(self, event):
+        if self.state.remove_member(event['group'], event['member']):
+            self.publish_user_groups(event['member'], removed=[event['group']])
+
+    def on_group_msg(self, event):
+        if self.state.get_group(event['group']) is not None:
+            record = self.history.append(group_channel(event['group']), 'chat', event['sender'], event['body'])
+            self.deliver_group(record, event['group'], event['sender'])
+
+    def handle_connection(self, sock, addr):
+        """Обработка подключения клиента в отдельном потоке."""
+        nickname = None
+        clean = False
+        conn = ThreadConnection(sock, addr, self.pump, self.new_queue())
+        try:
+            self.greet(conn, addr)
+            reader = FrameReader(sock)
+            for msg in reader:
+                nickname = self.handshake(conn, addr, msg)
+                if nickname is not None:
                     break
+            if not nickname:
+                nickname = None
+                return
 
-                elif msg.startswith("/p "):
-                    parts = msg.split(' ', 2)
-                    if len(parts) < 3:
-                        self.send_message(conn, 'Формат: /p ник_пользователя сообщение')
-                    else:
-                        recipient, private_msg = parts[1], parts[2]
-                        self.send_private_message(recipient, private_msg, nickname)
-
-                elif msg.startswith("/"):
-                    self.handle_group_command(nickname, msg, conn)
-                else:
-                    result_msg = f'[{nickname}] {msg}'
-                    self.send_message_to_all(message=result_msg, sender_nickname=nickname)
+            for msg in reader:
+                conn.wait_drained()
+                if not self.handle_message(nickname, msg, conn):
+                    clean = True
+                    break
         except Exception as e:
             print(f'Ошибка с клиентом {addr}: {e}')
         finally:
             conn.close()
-            if nickname and nickname in self.connections:
-                del self.connections[nickname]
+            if nickname:
+                self.disconnect(nickname, conn, clean)
+
+    def start_http(self):
+        """Запуск HTTP API в собственном цикле событий (режим threads; в asyncio он в цикле чата)."""
+        if self.http_port is not None:
+            self.api.start('0.0.0.0', self.http_port)
 
     def run(self):
-        """Запуск сервера."""
+        """Запуск сервера в выбранном режиме."""
+        if self.workers > 1:
+            self.run_workers()
+            return
         try:
             self.socket.bind((self.host, self.port))
             self.socket.listen()
-            print(f'Сервер запущен на {self.get_ip()}:{self.port}')
-            flask_thread = threading.Thread(target=self.app.run,
-                                            kwargs={'host': '0.0.0.0', 'port': 5000, 'debug': False})
-            flask_thread.daemon = True
-            flask_thread.start()
-            while True:
-                conn, addr = self.socket.accept()
-                print(f'Соединение установлено: {conn}, {addr}')
-                threading.Thread(target=self.handle_connection, args=(conn, addr)).start()
+            self.bus.start(self.handle_bus_event)
+            print(f'Сервер запущен на {self.get_ip()}:{self.port} (режим {self.mode}, узел {self.bus.node})')
+            if self.mode == 'asyncio':
+                engine.run(self)
+            else:
+                self.start_http()
+                self.serve_threads()
         except Exception as err:
             print(f'Error: {err}')
         finally:
             self.socket.close()
+            self.bus.close()
+            if self.group_journal is not None:
+                self.group_journal.close()
+            self.db.close()
+
+    def run_workers(self):
+        """Многоядерный режим: рабочие процессы принимают соединения на общем порту (SO_REUSEPORT).
+
+        Каждый процесс - отдельный узел кластера со своим циклом обслуживания. Пользователи, группы
+        и сообщения согласуются через брокер: он запускается в этом процессе, а если сервер уже
+        подключён к шине кластера, процессы становятся её узлами. История у каждого процесса своя,
+        но полная (общий чат, группы и личные сообщения приходят всем узлам), группы хранит брокер,
+        HTTP API обслуживает первый процесс.
+        """
+        broker = None
+        stem, ext = os.path.splitext(self.db_file)
+        if self.bus.clustered:
+            address, prefix = self.bus.address, self.bus.node
+        else:
+            broker = Broker('127.0.0.1', 0, db_file=f'{stem}-broker{ext}')
+            broker.start()
+            address, prefix = (broker.host, broker.port), 'worker'
+        # spawn, а не fork: в этом процессе уже работают потоки брокера и писателя базы.
+        context = multiprocessing.get_context('spawn')
+        processes = []
+        for index in range(self.workers):
+            options = {"host": self.host, "port": self.port, "mode": self.mode,
+                       "outbound_policy": self.outbound_policy, "db_file": f'{stem}-{prefix}{index}{ext}',
+                       "http_port": self.http_port if index == 0 else None, "reuse_port": True,
+                       "rate_limits": self.rate_limits}
+            process = context.Process(target=run_worker, args=(options, address, f'{prefix}{index}'),
+                                      name=f'chat-{prefix}{index}', daemon=True)
+            process.start()
+            processes.append(process)
+        print(f'Запущено рабочих процессов: {self.workers} на порту {self.port}')
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
+        finally:
+            self.db.close()
+
+    def serve_threads(self):
+        """Обслуживание клиентов по потоку на соединение."""
+        self.pump = OutboundPump()
+        self.pump.start()
+        while True:
+            conn, addr = self.socket.accept()
+            print(f'Соединение установлено: {conn}, {addr}')
+            threading.Thread(target=self.handle_connection, args=(conn, addr)).start()
+
+
+def run_worker(options, bus_address, node):
+    """Точка входа рабочего процесса: свой сервер, подключённый к брокеру как узел кластера."""
+    ChatServer(bus=BrokerBus(tuple(bus_address), node), **options).run()
 
 
 if __name__ == '__main__':
-    server = ChatServer()
+    parser = argparse.ArgumentParser(description='Сервер чата')
+    parser.add_argument('--port', type=int, default=9090)
+    parser.add_argument('--mode', choices=MODES, default='threads',
+                        help='threads - поток на клиента, asyncio - единый цикл событий')
+    parser.add_argument('--slow-policy', choices=POLICIES, default='drop_oldest',
+                        help='что делать с клиентом, чья исходящая очередь переполнена')
+    parser.add_argument('--http-port', type=int, default=5000)
+    parser.add_argument('--bus', help=f'адрес брокера кластера, например tcp://127.0.0.1:{BUS_PORT}')
+    parser.add_argument('--broker', action='store_true', help='запустить брокер кластера в этом процессе')
+    parser.add_argument('--node', help='имя узла в кластере (по умолчанию node<порт>)')
+    parser.add_argument('--client-rate', type=float, default=CLIENT_RATE,
+                        help='сообщений в секунду от одного клиента (0 - без ограничения)')
+    parser.add_argument('--client-burst', type=int, default=CLIENT_BURST, help='допустимый всплеск сообщений клиента')
+    parser.add_argument('--channel-rate', type=float, default=CHANNEL_RATE,
+                        help='сообщений в секунду в один канал: общий чат или группу (0 - без ограничения)')
+    parser.add_argument('--channel-burst', type=int, default=CHANNEL_BURST, help='допустимый всплеск сообщений канала')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='число рабочих процессов на общем порту (SO_REUSEPORT), по одному на ядро')
+    args = parser.parse_args()
+    node = args.node or f'node{args.port}'
+    bus_url = args.bus or (f'tcp://127.0.0.1:{BUS_PORT}' if args.broker else None)
+    if args.broker:
+        bus_address = urlsplit(bus_url)
+        Broker(bus_address.hostname, bus_address.port, db_file='chat-broker.db').start()
+    # У каждого узла кластера своя база: идентификаторы истории выдаются внутри процесса.
+    server = ChatServer(port=args.port, mode=args.mode, outbound_policy=args.slow_policy,
+                        bus=make_bus(bus_url, node), db_file=f'chat-{node}.db' if bus_url else 'chat.db',
+                        http_port=args.http_port, workers=args.workers,
+                        rate_limits={"client_rate": args.client_rate, "client_burst": args.client_burst,
+                                     "channel_rate": args.channel_rate, "channel_burst": args.channel_burst})
     server.run()
@@ -0,0 +1,181 @@
+"""Возобновляемые сессии клиентов.
+
+При входе клиент получает токен сессии. Если связь оборвалась без CLOSE, ник остаётся за ним
+SESSION_GRACE секунд: в состоянии вместо соединения стоит DetachedConnection, остальные не видят
+ни выхода, ни повторного входа. Вернувшийся клиент предъявляет токен и id последнего увиденного
+сообщения и получает только пропущенное.
+
+Таймеры ожидания в режиме asyncio ставятся в цикл событий (loop.call_later), в режиме threads -
+в общую очередь TimerQueue с одним потоком, а не по потоку на каждый обрыв связи.
+"""
+import heapq
+import itertools
+import secrets
+import threading
+import time
+
+from outbound import OutboundQueue
+
+SESSION_GRACE = 30
+
+
+class DetachedConnection:
+    """Заглушка вместо оборванного соединения: кадры отбрасываются, пропущенное берётся из истории."""
+
+    def __init__(self, addr, codec):
+        self.addr = addr
+        self.codec = codec
+        self.bucket = None
+        self.queue = OutboundQueue()
+
+    def push(self, data, key=None):
+        return True
+
+    def close(self):
+        pass
+
+    abort = close
+
+    def __repr__(self):
+        return f'<DetachedConnection {self.addr}>'
+
+
+def new_token():
+    return secrets.token_urlsafe(16)
+
+
+class Session:
+    __slots__ = ('token', 'nickname', 'detached', 'timer')
+
+    def __init__(self, token, nickname):
+        self.token = token
+        self.nickname = nickname
+        self.detached = None  # DetachedConnection, пока клиент не вернулся
+        self.timer = None
+
+
+class Timer:
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerQueue:
+    """Отложенные вызовы в одном потоке: куча по времени срабатывания; отменённые просто пропускаются."""
+
+    def __init__(self):
+        self.heap = []  # [(время, порядковый номер, Timer)]
+        self.order = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def call_later(self, delay, callback, *args):
+        """Вызов callback(*args) через delay секунд; возвращает таймер с методом cancel()."""
+        timer = Timer(time.monotonic() + delay, callback, args)
+        with self.cond:
+            heapq.heappush(self.heap, (timer.when, next(self.order), timer))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='session-timers', daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        return timer
+
+    def run(self):
+        while True:
+            with self.cond:
+                timer = self.next_due()
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                print(f'Ошибка таймера сессии: {e}')
+
+    def next_due(self):
+        """Ожидание ближайшего неотменённого таймера (вызывать под self.cond)."""
+        while True:
+            while self.heap and self.heap[0][2].cancelled:
+                heapq.heappop(self.heap)
+            if not self.heap:
+                self.cond.wait()
+                continue
+            delay = self.heap[0][0] - time.monotonic()
+            if delay <= 0:
+                return heapq.heappop(self.heap)[2]
+            self.cond.wait(delay)
+
+
+class SessionTable:
+    """Сессии по токенам и никам; по истечении ожидания вызывается expire(session).
+
+    call_later(delay, callback, *args) ставит таймер с методом cancel(): по умолчанию в общую
+    TimerQueue, в режиме asyncio - loop.call_later (тогда методы вызываются из цикла событий).
+    """
+
+    def __init__(self, grace=SESSION_GRACE, call_later=None):
+        self.grace = grace
+        self.call_later = call_later or TimerQueue().call_later
+        self.lock = threading.Lock()
+        self.tokens = {}  # {token: Session}
+        self.nicknames = {}  # {nickname: Session}
+
+    def open(self, nickname, token=None):
+        """Новая сессия вошедшего пользователя (или перешедшей с другого узла - с её токеном). Возвращает её."""
+        session = Session(token or new_token(), nickname)
+        with self.lock:
+            self.tokens[session.token] = session
+            self.nicknames[nickname] = session
+        return session
+
+    def get(self, nickname):
+        return self.nicknames.get(nickname)
+
+    def owner(self, token):
+        """Ник владельца сессии по токену; None, если токен неизвестен."""
+        session = self.tokens.get(token) if token else None
+        return session.nickname if session is not None else None
+
+    def detach(self, session, detached, expire):
+        """Клиент отключился: сессия ждёт его grace секунд, затем вызывается expire(session)."""
+        with self.lock:
+            session.detached = detached
+            session.timer = self.call_later(self.grace, expire, session)
+
+    def claim(self, token):
+        """Возвращение клиента по токену: (сессия, заглушка) или None, если сессия неизвестна или активна."""
+        with self.lock:
+            session = self.tokens.get(token)
+            if session is None or session.detached is None:
+                return None
+            session.timer.cancel()
+            session.timer = None
+            detached, session.detached = session.detached, None
+            return session, detached
+
+    def expire(self, session):
+        """Истечение ожидания: заглушка, если клиент так и не вернулся (сессия удаляется), иначе None."""
+        with self.lock:
+            detached, session.detached = session.detached, None
+            if detached is None:
+                return None
+            self._remove(session)
+            return detached
+
+    def close(self, session):
+        """Удаление сессии при выходе из чата."""
+        with self.lock:
+            if session.timer is not None:
+                session.timer.cancel()
+            session.detached = None
+            self._remove(session)
+
+    def _remove(self, session):
+        session.timer = None
+        self.tokens.pop(session.token, None)
+        if self.nicknames.get(session.nickname) is session:
+            del self.nicknames[session.nickname]
@@ -0,0 +1,349 @@
+"""Индексированное состояние чата в памяти: пользователи онлайн, группы и членство в них.
+
+Состояние потокобезопасно. Читатели (рассылки, HTTP API) не берут блокировок: словари
+соединений и множества участников заменяются целиком при записи (copy-on-write), поэтому
+итерация всегда идёт по неизменяемому снимку. Писатели:
+
+- список пользователей (add_user, remove_user, replace_connection, take_over, hand_over и
+  пользователи других узлов) меняется под одной общей roster_lock: шарды словаря соединений
+  нужны читателям, а версии списка идут подряд. Сервер держит её и снаружи, чтобы рассылка
+  изменения списка шла в том же порядке, что и версии;
+- группа меняется под блокировкой своего шарда, обратный индекс членства - под блокировкой
+  шарда пользователя;
+- кэш подключённых участников групп - под _live_lock.
+
+Порядок блокировок: roster_lock, затем _live_lock; шард группы, затем шард пользователя.
+Под _live_lock другие блокировки не берутся.
+"""
+import threading
+from zlib import crc32
+
+from nameindex import PrefixIndex, search_names
+
+SHARDS = 16
+
+
+def shard_of(key):
+    """Номер шарда для ключа; crc32 не зависит от рандомизации hash() между процессами."""
+    return crc32(key.encode()) % SHARDS
+
+
+class Group:
+    """Группа: владелец и неизменяемое множество участников (заменяется при изменении)."""
+
+    __slots__ = ('name', 'owner', 'members')
+
+    def __init__(self, name, owner):
+        self.name = name
+        self.owner = owner
+        self.members = frozenset((owner,))
+
+
+class ChatState:
+    """Хранилище состояния с обратным индексом никнейм -> группы и версиями для рассылки изменений.
+
+    Все операции стоят O(1) или O(изменений); снимки для рассылки кэшируются до следующего изменения.
+    """
+
+    def __init__(self):
+        self.shards = [{} for _ in range(SHARDS)]  # [{nickname: (address, connection)}]
+        self.remote = {}  # {nickname: узел} - пользователи других узлов кластера
+        self.groups = {}  # {group_name: Group}
+        self.journal = None  # GroupJournal: изменения групп записываются под блокировкой шарда группы
+        self.memberships = {}  # {nickname: frozenset(group_name, ...)}
+        self.roster_version = 0
+        self.group_versions = {}  # {nickname: версия его списка групп}
+        self.user_index = PrefixIndex()  # ники онлайн (локальные и удалённые) для поиска по префиксу
+        # Подключённые к узлу участники групп для рассылки: {group_name: (members, ((ник, соединение), ...))}.
+        # Запись верна, пока у группы тот же объект members; вход, выход и смена соединения участника
+        # удаляют записи его групп. Проверка версии с записью в кэш и её сброс идут под _live_lock.
+        self._live = {}
+        self.connection_version = 0
+        self._live_lock = threading.Lock()
+        self._users = None
+        self._snapshots = {}  # {ключ: (версия, значение)}
+        # Вход и выход пользователей упорядочены одной блокировкой, чтобы версии списка шли подряд.
+        self.roster_lock = threading.RLock()
+        self._group_locks = [threading.Lock() for _ in range(SHARDS)]
+        self._member_locks = [threading.Lock() for _ in range(SHARDS)]
+
+    # Пользователи
+
+    def add_user(self, nickname, addr, conn):
+        """Регистрация пользователя онлайн. False, если ник уже занят."""
+        index = shard_of(nickname)
+        with self.roster_lock:
+            shard = self.shards[index]
+            if nickname in shard:
+                return False
+            updated = dict(shard)
+            updated[nickname] = (addr, conn)
+            self.shards[index] = updated
+            self.user_index.add(nickname)
+            self._connections_changed(nickname)
+            self._roster_changed()
+            return True
+
+    def remove_user(self, nickname, conn):
+        """Удаление пользователя, если ник всё ещё принадлежит этому соединению."""
+        index = shard_of(nickname)
+        with self.roster_lock:
+            shard = self.shards[index]
+            entry = shard.get(nickname)
+            if entry is None or entry[1] is not conn:
+                return False
+            updated = dict(shard)
+            del updated[nickname]
+            self.shards[index] = updated
+            self.user_index.discard(nickname)
+            self._connections_changed(nickname)
+            self._roster_changed()
+            return True
+
+    def replace_connection(self, nickname, old, addr, new):
+        """Подмена соединения пользователя без изменения списка. False, если ник уже не за old."""
+        index = shard_of(nickname)
+        with self.roster_lock:
+            shard = self.shards[index]
+            entry = shard.get(nickname)
+            if entry is None or entry[1] is not old:
+                return False
+            updated = dict(shard)
+            updated[nickname] = (addr, new)
+            self.shards[index] = updated
+            self._connections_changed(nickname)
+            return True
+
+    def add_remote_user(self, nickname, node):
+        """Регистрация пользователя, подключённого к другому узлу кластера."""
+        with self.roster_lock:
+            if self.is_online(nickname):
+                return False
+            remote = dict(self.remote)
+            remote[nickname] = node
+            self.remote = remote
+            self.user_index.add(nickname)
+            self._roster_changed()
+            return True
+
+    def remove_remote_user(self, nickname):
+        with self.roster_lock:
+            if nickname not in self.remote:
+                return False
+            remote = dict(self.remote)
+            del remote[nickname]
+            self.remote = remote
+            self.user_index.discard(nickname)
+            self._roster_changed()
+            return True
+
+    def take_over(self, nickname, addr, conn):
+        """Пользователь другого узла вернулся в сессию через этот. True, если его не было в списке."""
+        index = shard_of(nickname)
+        with self.roster_lock:
+            known = nickname in self.remote
+            if known:
+                remote = dict(self.remote)
+                del remote[nickname]
+                self.remote = remote
+            updated = dict(self.shards[index])
+            updated[nickname] = (addr, conn)
+            self.shards[index] = updated
+            self._connections_changed(nickname)
+            if not known:
+                self.user_index.add(nickname)
+                self._roster_changed()
+            return not known
+
+    def hand_over(self, nickname, node):
+        """Пользователь перешёл на другой узел кластера. True, если его не было в списке."""
+        index = shard_of(nickname)
+        with self.roster_lock:
+            shard = self.shards[index]
+            known = nickname in shard or nickname in self.remote
+            if nickname in shard:
+                updated = dict(shard)
+                del updated[nickname]
+                self.shards[index] = updated
+                self._connections_changed(nickname)
+            remote = dict(self.remote)
+            remote[nickname] = node
+            self.remote = remote
+            if not known:
+                self.user_index.add(nickname)
+                self._roster_changed()
+            return not known
+
+    def is_online(self, nickname):
+        """Пользователь в сети на этом или на другом узле."""
+        return nickname in self.shards[shard_of(nickname)] or nickname in self.remote
+
+    def node_of(self, nickname):
+        """Узел, к которому подключён удалённый пользователь, или None."""
+        return self.remote.get(nickname)
+
+    def get_connection(self, nickname):
+        """Соединение пользователя или None, если он не в сети."""
+        entry = self.shards[shard_of(nickname)].get(nickname)
+        return entry[1] if entry else None
+
+    def iter_connections(self):
+        """Итерация по локальным (nickname, (address, connection)) без блокировок, по снимкам шардов."""
+        for shard in list(self.shards):
+            yield from shard.items()
+
+    def users(self):
+        """Отсортированный кортеж ников онлайн (кэшируется до изменения списка)."""
+        users = self._users
+        if users is None:
+            with self.roster_lock:
+                if self._users is None:
+                    local = [nickname for shard in self.shards for nickname in shard]
+                    self._users = tuple(sorted(local + list(self.remote)))
+                users = self._users
+        return users
+
+    def users_except(self, nickname):
+        return [user for user in self.users() if user != nickname]
+
+    def search_users(self, prefix, limit):
+        """Ники онлайн, начинающиеся с prefix (без учёта регистра), не больше limit."""
+        return self.user_index.search(prefix, limit)
+
+    def roster_cached(self, key, build):
+        """Значение, построенное по текущему списку пользователей и закэшированное до его изменения."""
+        with self.roster_lock:
+            entry = self._snapshots.get(key)
+            if entry is not None and entry[0] == self.roster_version:
+                return entry[1]
+            value = build()
+            self._snapshots[key] = (self.roster_version, value)
+            return value
+
+    def _connections_changed(self, nickname):
+        with self._live_lock:
+            self.connection_version += 1
+            for group_name in self.memberships.get(nickname, ()):
+                self._live.pop(group_name, None)
+
+    def _roster_changed(self):
+        self.roster_version += 1
+        self._users = None
+
+    # Группы
+
+    def get_group(self, group_name):
+        return self.groups.get(group_name)
+
+    def create_group(self, group_name, owner):
+        """Создание группы. None, если такая уже есть."""
+        with self._group_locks[shard_of(group_name)]:
+            if group_name in self.groups:
+                return None
+            group = Group(group_name, owner)
+            self.groups[group_name] = group
+            self._link(group_name, owner)
+            self._record('create', group_name, owner)
+            return group
+
+    def group_connections(self, group_name):
+        """Подключённые к этому узлу участники группы: кортеж (ник, соединение), кэшируется до изменений.
+
+        Если во время сборки кто-то вошёл или вышел, результат не кэшируется: запись могла устареть.
+        """
+        group = self.groups.get(group_name)
+        if group is None:
+            return ()
+        members = group.members
+        cached = self._live.get(group_name)
+        if cached is not None and cached[0] is members:
+            return cached[1]
+        version = self.connection_version
+        shards = self.shards
+        live = []
+        for member in members:
+            entry = shards[shard_of(member)].get(member)
+            if entry is not None:
+                live.append((member, entry[1]))
+        live = tuple(live)
+        with self._live_lock:
+            if version == self.connection_version:
+                self._live[group_name] = (members, live)
+        return live
+
+    def is_member(self, group_name, nickname):
+        group = self.groups.get(group_name)
+        return group is not None and nickname in group.members
+
+    def add_member(self, group_name, nickname):
+        """Добавление участника. False, если группы нет или он уже в ней."""
+        with self._group_locks[shard_of(group_name)]:
+            group = self.groups.get(group_name)
+            if group is None or nickname in group.members:
+                return False
+            group.members = group.members | {nickname}
+            self._link(group_name, nickname)
+            self._record('add', group_name, nickname)
+            return True
+
+    def remove_member(self, group_name, nickname):
+        """Исключение участника. False, если его не было в группе."""
+        with self._group_locks[shard_of(group_name)]:
+            group = self.groups.get(group_name)
+            if group is None or nickname not in group.members:
+                return False
+            group.members = group.members - {nickname}
+            self._unlink(group_name, nickname)
+            self._record('remove', group_name, nickname)
+            return True
+
+    def restore_groups(self, groups):
+        """Загрузка сохранённых групп {группа: (владелец, участники)} при запуске, до приёма клиентов."""
+        memberships = {}
+        for group_name, (owner, members) in groups.items():
+            group = Group(group_name, owner)
+            group.members = frozenset(members)
+            self.groups[group_name] = group
+            for member in members:
+                memberships.setdefault(member, set()).add(group_name)
+        for nickname, names in memberships.items():
+            self.memberships[nickname] = self.memberships.get(nickname, frozenset()) | names
+
+    def group_entries(self):
+        """(группа, владелец, участники) по всем группам - источник снимков журнала."""
+        return [(group.name, group.owner, group.members) for group in list(self.groups.values())]
+
+    def search_groups(self, prefix, limit, nickname):
+        """Группы пользователя, начинающиеся с prefix, не больше limit.
+
+        Перебираются только его группы из обратного индекса: обход общего индекса с отбором по членству
+        при коротком префиксе прошёл бы все группы сервера.
+        """
+        return search_names(self.memberships.get(nickname, ()), prefix, limit)
+
+    def user_groups(self, nickname):
+        """Отсортированный список групп пользователя по обратному индексу."""
+        return sorted(self.memberships.get(nickname, ()))
+
+    def group_version(self, nickname):
+        return self.group_versions.get(nickname, 0)
+
+    def _record(self, op, group_name, nickname):
+        if self.journal is not None:
+            self.journal.record(op, group_name, nickname)
+
+    # Блокировки берутся в порядке: шард группы, затем шард пользователя.
+
+    def _link(self, group_name, nickname):
+        with self._member_locks[shard_of(nickname)]:
+            self.memberships[nickname] = self.memberships.get(nickname, frozenset()) | {group_name}
+            self.group_versions[nickname] = self.group_version(nickname) + 1
+
+    def _unlink(self, group_name, nickname):
+        with self._member_locks[shard_of(nickname)]:
+            groups = self.memberships.get(nickname, frozenset()) - {group_name}
+            if groups:
+                self.memberships[nickname] = groups
+            else:
+                self.memberships.pop(nickname, None)
+            self.group_versions[nickname] = self.group_version(nickname) + 1
@@ -0,0 +1,179 @@
+"""Хранение данных чата в SQLite.
+
+Чтения идут через небольшой пул соединений (sqlite3 кэширует подготовленные выражения на
+соединение): сколько бы потоков ни обращалось к базе, открыто не больше POOL_SIZE соединений.
+База работает в режиме WAL, а записи копятся в очереди и фиксируются пачками фоновым потоком
+со своим соединением.
+"""
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import REGISTRY, SIZE_BUCKETS
+
+BATCH_SIZE = 512
+STATEMENT_CACHE = 256
+POOL_SIZE = 8
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS nicknames (
+           nickname TEXT PRIMARY KEY,
+           ip_address TEXT)''',
+    'CREATE INDEX IF NOT EXISTS nicknames_ip_address ON nicknames (ip_address)',
+    '''CREATE TABLE IF NOT EXISTS inbox_cursors (
+           nickname TEXT PRIMARY KEY,
+           last_id INTEGER NOT NULL)''',
+)
+
+SAVE_NICKNAME = 'INSERT OR REPLACE INTO nicknames (nickname, ip_address) VALUES (?, ?)'
+SELECT_NICKNAMES = 'SELECT nickname FROM nicknames WHERE ip_address = ?'
+SAVE_INBOX_CURSOR = 'INSERT OR REPLACE INTO inbox_cursors (nickname, last_id) VALUES (?, ?)'
+SELECT_INBOX_CURSOR = 'SELECT last_id FROM inbox_cursors WHERE nickname = ?'
+
+_STOP = object()
+
+DB_SECONDS = REGISTRY.histogram('chat_db_seconds', 'Длительность обращений к SQLite', ('operation',))
+DB_BATCH_SIZE = REGISTRY.histogram('chat_db_batch_size', 'Записей в одной транзакции фонового писателя',
+                                   buckets=SIZE_BUCKETS)
+DB_ERRORS = REGISTRY.counter('chat_db_errors_total', 'Ошибки SQLite', ('operation',))
+
+
+class Database:
+    """Ограниченный пул соединений для чтения и фоновый писатель с групповой фиксацией."""
+
+    def __init__(self, path, batch_size=BATCH_SIZE, pool_size=POOL_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.pool_size = pool_size
+        self.pool = queue.LifoQueue()  # свободные соединения; последнее вернувшееся - самое "тёплое"
+        self.opened = 0
+        self.pool_lock = threading.Lock()
+        self.writes = queue.Queue()
+        self.init_schema()
+        self.writer = threading.Thread(target=self.write_loop, name='db-writer', daemon=True)
+        self.writer.start()
+
+    def open(self):
+        conn = sqlite3.connect(self.path, timeout=10, cached_statements=STATEMENT_CACHE, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Соединение из пула на время обращения; если открыты все pool_size, ждём освободившееся."""
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            with self.pool_lock:
+                create = self.opened < self.pool_size
+                if create:
+                    self.opened += 1
+            if not create:
+                conn = self.pool.get()
+            else:
+                try:
+                    conn = self.open()
+                except sqlite3.Error:
+                    with self.pool_lock:
+                        self.opened -= 1
+                    raise
+        try:
+            yield conn
+        finally:
+            self.pool.put(conn)
+
+    def init_schema(self, statements=SCHEMA):
+        """Создание таблиц и индексов, если их ещё нет."""
+        with self.connection() as conn, conn:
+            for statement in statements:
+                conn.execute(statement)
+
+    def query(self, sql, params=()):
+        """Чтение через соединение из пула."""
+        with DB_SECONDS.time('query'), self.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def execute_later(self, sql, params):
+        """Постановка записи в очередь фонового писателя."""
+        self.writes.put((sql, params))
+
+    def write_loop(self):
+        """Фоновый писатель: забирает всё накопившееся и фиксирует одной транзакцией."""
+        conn = self.open()
+        while True:
+            item = self.writes.get()
+            batch = [item]
+            while item is not _STOP and len(batch) < self.batch_size:
+                try:
+                    item = self.writes.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+            stop = batch[-1] is _STOP
+            if stop:
+                batch.pop()
+            started = time.perf_counter()
+            try:
+                self.commit_batch(conn, batch)
+            except sqlite3.Error as e:
+                DB_ERRORS.inc('commit')
+                print(f"Ошибка записи в базу данных: {e}")
+            finally:
+                for _ in range(len(batch) + stop):
+                    self.writes.task_done()
+            DB_SECONDS.observe(time.perf_counter() - started, 'commit')
+            DB_BATCH_SIZE.observe(len(batch))
+            if stop:
+                conn.close()
+                return
+
+    @staticmethod
+    def commit_batch(conn, batch):
+        """Подряд идущие одинаковые выражения выполняются одним executemany."""
+        with conn:
+            start = 0
+            while start < len(batch):
+                sql = batch[start][0]
+                end = start
+                while end < len(batch) and batch[end][0] == sql:
+                    end += 1
+                conn.executemany(sql, [params for _, params in batch[start:end]])
+                start = end
+
+    def pending(self):
+        """Число записей, ещё не зафиксированных фоновым писателем."""
+        return self.writes.qsize()
+
+    def flush(self):
+        """Ожидание, пока все поставленные записи не будут зафиксированы."""
+        with DB_SECONDS.time('flush'):
+            self.writes.join()
+
+    def close(self):
+        self.writes.put(_STOP)
+        self.writer.join()
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    # Никнеймы
+
+    def save_nickname(self, nickname, ip_address):
+        self.execute_later(SAVE_NICKNAME, (nickname, ip_address))
+
+    def latest_nicknames(self, ip_address):
+        return [row[0] for row in self.query(SELECT_NICKNAMES, (ip_address,))]
+
+    # Входящие для ушедших пользователей: id последнего сообщения, существовавшего при выходе
+
+    def save_inbox_cursor(self, nickname, last_id):
+        self.execute_later(SAVE_INBOX_CURSOR, (nickname, last_id))
+
+    def inbox_cursor(self, nickname):
+        rows = self.query(SELECT_INBOX_CURSOR, (nickname,))
+        return rows[0][0] if rows else None
@@ -0,0 +1,99 @@
+"""Нагрузочная проверка ChatState: сотни потоков одновременно входят, выходят, вступают в группы и рассылают."""
+import os
+import random
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'base'))
+
+from state import ChatState  # noqa: E402
+
+CLIENTS = 300
+ROUNDS = 20
+GROUPS = 8
+CONTENDERS = 16
+
+
+class FakeConnection:
+    def __init__(self, nickname):
+        self.nickname = nickname
+        self.delivered = 0
+
+
+def run_threads(count, target):
+    barrier = threading.Barrier(count)
+    errors = []
+
+    def worker(index):
+        barrier.wait()
+        try:
+            target(index)
+        except BaseException as e:  # ошибка в потоке должна провалить тест, а не потеряться
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors[:3]
+
+
+def test_concurrent_join_leave_broadcast():
+    state = ChatState()
+    groups = [f'group{index}' for index in range(GROUPS)]
+    for group_name in groups:
+        state.create_group(group_name, 'owner')
+
+    def client(index):
+        nickname = f'user{index}'
+        rng = random.Random(index)
+        for _ in range(ROUNDS):
+            conn = FakeConnection(nickname)
+            assert state.add_user(nickname, ('127.0.0.1', index), conn)
+            assert state.get_connection(nickname) is conn
+            group_name = rng.choice(groups)
+            assert state.add_member(group_name, nickname)
+            # Рассылка в общий чат: снимок шардов не меняется во время обхода.
+            for other, (_, other_conn) in state.iter_connections():
+                assert other_conn.nickname == other
+                other_conn.delivered += 1
+            for member, member_conn in state.group_connections(group_name):
+                assert member_conn.nickname == member
+            assert nickname in state.users()
+            assert state.remove_member(group_name, nickname)
+            assert state.remove_user(nickname, conn)
+            assert not state.remove_user(nickname, conn)
+
+    run_threads(CLIENTS, client)
+
+    assert list(state.iter_connections()) == []
+    assert state.users() == ()
+    assert len(state.user_index) == 0
+    assert state.roster_version == 2 * CLIENTS * ROUNDS
+    for group_name in groups:
+        assert state.get_group(group_name).members == {'owner'}
+        # Кэш подключённых участников не должен пережить выход пользователей.
+        assert state.group_connections(group_name) == ()
+    assert state.memberships == {'owner': frozenset(groups)}
+    for index in range(CLIENTS):
+        assert state.group_version(f'user{index}') == 2 * ROUNDS
+
+
+def test_concurrent_logins_with_one_nickname():
+    state = ChatState()
+    winners = []
+    lock = threading.Lock()
+
+    def contender(index):
+        conn = FakeConnection('shared')
+        if state.add_user('shared', ('127.0.0.1', index), conn):
+            with lock:
+                winners.append(conn)
+
+    run_threads(CONTENDERS, contender)
+
+    assert len(winners) == 1
+    assert state.get_connection('shared') is winners[0]
+    assert state.users() == ('shared',)
+    assert state.roster_version == 1
@@ -0,0 +1,86 @@
+"""HTTP /history в режиме --workers: токен сессии принимается, к какому бы процессу ни подключился клиент."""
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import pytest
+
+BASE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'base')
+sys.path.insert(0, BASE)
+
+from protocol import FrameReader, decode_message, encode_frame, hello_message  # noqa: E402
+
+CLIENTS = 12
+WORKERS = 2
+STARTUP_TIMEOUT = 20
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, 'SO_REUSEPORT'), reason='нужен SO_REUSEPORT')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_port(port, process):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        assert process.poll() is None, 'сервер завершился при запуске'
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError(f'порт {port} не открылся')
+
+
+def read_until(frames, predicate):
+    for frame in frames:
+        msg, control, _ = decode_message(frame)
+        if predicate(msg, control):
+            return msg, control
+    raise ConnectionError('соединение закрыто')
+
+
+@pytest.fixture
+def workers_server():
+    port, http_port = free_port(), free_port()
+    with tempfile.TemporaryDirectory(prefix='chat-workers-') as workdir:
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(BASE, 'server.py'), '--port', str(port), '--http-port', str(http_port),
+             '--mode', 'asyncio', '--workers', str(WORKERS)],
+            cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_port(http_port, process)
+            yield port, http_port
+        finally:
+            process.terminate()
+            process.wait(10)
+
+
+def test_history_accepts_sessions_of_every_worker(workers_server):
+    port, http_port = workers_server
+    clients = []
+    try:
+        for index in range(CLIENTS):
+            sock = socket.create_connection(('127.0.0.1', port), timeout=STARTUP_TIMEOUT)
+            clients.append(sock)
+            sock.sendall(encode_frame(hello_message()) + encode_frame(f'user{index}'))
+            frames = FrameReader(sock, raw=True)
+            _, welcome = read_until(frames, lambda msg, control: control and control[0] == 'welcome')
+            sock.sendall(encode_frame(f'/create_group room{index}'))
+            read_until(frames, lambda msg, control: msg == f'Группа room{index} создана.')
+
+            query = f'channel=group:room{index}&session={welcome[1]["session"]}'
+            with urllib.request.urlopen(f'http://127.0.0.1:{http_port}/history?{query}', timeout=10) as response:
+                assert response.status == 200
+                assert json.load(response)['channel'] == f'group:room{index}'
+    finally:
+        for sock in clients:
+            sock.close()